@@ -1,49 +1,138 @@
+import time
+
+STARTED = time.perf_counter()  # startup is timed from here, before the slower imports
+
 import asyncio
 import discord
 from discord.ext import commands
 import random
-from betrayalplayer import BetrayalPlayer
-from gtts import gTTS
-import datetime
-import pickle
+from betrayal import BetrayalSessions, MAX_PLAYERS, PICK_EMOJI, PICKS
+from quotestore import QuoteStore
+from ttscache import TTSCache, load_gtts
+from ttspipeline import TTSPipeline, split_text
+from soundlibrary import SoundLibrary, load_opus
+from mixer import Mixer
+from soundboard import ClipQueue, COOLDOWN, FULL
+from wordlists import WordLists
+from outbox import Outbox, CHATTER
+from messageindex import MessageIndex, MessageRef, BULK_DELETE_AGE, BULK_DELETE_LIMIT, time_snowflake
+from paginator import QuotePages
+from quoteindex import QuoteIndex
+from resolver import TrackResolver, PLAYLIST_URL, load_youtube_dl
+from trackcache import TrackCache
+from ytcache import YTCache
+import fakegateway
+import metrics
+import dice
+import odds
+from watchdog import StallWatchdog
+import functools
+import itertools
+import os
 import re
-from threading import Lock, Thread
-
-if not discord.opus.is_loaded():
-    # the 'opus' library here is opus.dll on windows
-    # or libopus.so on linux in the current directory
-    # you should replace this with the location the
-    # opus library is located in and with the proper filename.
-    # note that on windows this DLL is automatically provided for you
-    discord.opus.load_opus('opus')
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+# id of the user that can make the bot talk and use admin commands, the owner of the bot's application if not set
+OWNER_ID = os.environ.get("JERRY_OWNER_ID")
+
+# set by shards.py when the bot is run as several processes, each connected as one shard
+SHARD_ID = int(os.environ.get("JERRY_SHARD_ID", "0"))
+SHARD_COUNT = int(os.environ.get("JERRY_SHARD_COUNT", "1"))
+FAKE_GATEWAY = float(os.environ.get("JERRY_FAKE_GATEWAY", "0"))  # seconds to run against fakegateway instead
+
+METRICS_PORT = 9200  # prometheus metrics are served on localhost at this port plus the shard id
+COMMANDS_RUN = metrics.counter("jerry_commands_total", "Commands invoked", ("command",))
+STALL_THRESHOLD = 0.1  # seconds the event loop can be blocked before the stack blocking it is kept
+COMMAND_SECONDS = metrics.histogram("jerry_command_seconds", "Time commands took to finish", ("command",))
+
+PREFETCH_SONGS = 3  # songs at the front of the queue that have their streams kept fresh
+PREFETCH_BEFORE = 30  # seconds before a song ends that the next songs' streams are looked up again if old
+MAX_QUEUED = 100  # songs waiting in a server's queue
+PLAYLIST_SONGS = 500  # most songs queued from one playlist
+PLAYLIST_AHEAD = 10  # songs from a playlist kept waiting in the queue, the rest are added as these play
+PLAYLIST_PAGE = 25  # songs read from a playlist at once
+IDLE_TIMEOUT = 10 * 60  # seconds a server plays nothing before the bot leaves voice and forgets its state
+REAP_EVERY = 60  # seconds between checks for idle servers
+
+CLIPS_QUEUED = 5  # soundboard clips waiting to play in a server
+CLIP_MERGE = 2.0  # seconds after a clip starts that asking for it again does not play it twice
+CLIP_COOLDOWN = 3.0  # seconds a user has to wait between soundboard clips
+
+TTS_WORKERS = 4  # threads used to synthesise tts
+TTS_MAX_IN_FLIGHT = 4  # most tts syntheses running at once over all servers
+ODDS_WORKERS = 1  # threads !odds is worked out on, kept apart from youtube-dl, sqlite and audio jobs
+TRACK_CACHE_BYTES = 2 * 1024 * 1024 * 1024  # disk space songs played often are saved in
+
+HISTORY_LIMIT = 1000  # messages of history !cleanup reads at most for messages from before the bot started
+BETRAYAL_TIMEOUT = 60  # seconds a betrayal game waits for the next character to be chosen
+
+# reactions used to move between pages of !qlist
+PREVIOUS_PAGE = '\u25c0'
+NEXT_PAGE = '\u25b6'
+
+# word lists, each has a command of the same name that writes 3 random lines from the file
+WORD_LISTS = {
+    "fmk": "fmk.txt",
+    "fmkg": "fmk girl.txt",
+    "fmkb": "fmk boy.txt",
+    "fmkd": "fmkd.txt",
+}
 
 """
 Represents message returned when song requested by user
 Holds the requester of song, channel song will be played in and 
-player used to play song
+player used to play song. The song is looked up in the background after
+it is queued, and the player is only made just before it plays
 """
 class VoiceEntry:
-    def __init__(self, message, player):
+    def __init__(self, message, query):
         self.requester = message.author
         self.channel = message.channel
-        self.player = player
+        self.query = query  # what was asked for, url or search text
+        self.info = None  # details youtube-dl found, None until looked up
+        self.resolving = None  # future of the youtube-dl lookup
+        self.resolved_at = None
+        self.player = None
+        self.playlist = None  # title of playlist the song was queued from
+
+    @property
+    def title(self):
+        if self.info is None:
+            return self.query
+        return self.info.get('title') or self.query
+
+    @property
+    def duration(self):
+        if self.info is None:
+            return None
+        return self.info.get('duration')
 
     def __str__(self):
         fmt = '*{0.title}* requested by {1.display_name}'
-        duration = self.player.duration
+        duration = self.duration
         if duration:  # if duration longer then 0, return length of song
             fmt = fmt + ' [length: {0[0]}m {0[1]}s]'.format(divmod(duration, 60))
-        return fmt.format(self.player, self.requester)
+        return fmt.format(self, self.requester)
 
 # Represents state of robot used when song is playing
 class VoiceState:
-    def __init__(self, bot):
+    def __init__(self, bot, resolver, sounds, mixer_stopped=None):
         self.current = None  # songs currently in list
         self.voice = None
+        self.mixer = None  # plays music and sounds together through voice
+        self.mixer_stopped = mixer_stopped  # called with the mixer once it stops, so its counts are kept
         self.bot = bot
+        self.resolver = resolver
+        self.sounds = sounds
+        self.clips = ClipQueue(bot.loop, self.play_clip, max_queued=CLIPS_QUEUED, merge_within=CLIP_MERGE,
+                               cooldown=CLIP_COOLDOWN)  # soundboard clips waiting their turn
         self.play_next_song = asyncio.Event()
-        self.songs = asyncio.Queue()
-        self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+        self.songs = asyncio.Queue(maxsize=MAX_QUEUED)
+        self.song_taken = asyncio.Event()  # set each time a song is taken from the queue to play
+        self.importing = None  # task queueing songs from a playlist
+        self.audio_player = None  # task playing songs, started when the first song is queued
+        self.last_active = time.monotonic()
 
     # checks is bot is currently playing song
     def is_playing(self):
@@ -63,20 +152,122 @@ class VoiceState:
     def toggle_next(self):
         self.bot.loop.call_soon_threadsafe(self.play_next_song.set)
 
+    # marks state as used now so it is not reaped
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    # queues song, starting the task that plays songs if it is not running
+    async def enqueue(self, entry):
+        if self.audio_player is None or self.audio_player.done():
+            self.audio_player = self.bot.loop.create_task(self.audio_player_task())
+        self.touch()
+        await self.songs.put(entry)
+
+    # True if nothing is playing or waiting to play and nothing has been for timeout seconds
+    def is_idle(self, timeout):
+        if self.is_playing() or not self.songs.empty() or (self.mixer is not None and self.mixer.is_playing()):
+            return False
+        if len(self.clips) or (self.importing is not None and not self.importing.done()):
+            return False
+        return time.monotonic() - self.last_active > timeout
+
+    def tasks(self):
+        return [task for task in (self.audio_player, self.importing, self.clips.task)
+                if task is not None and not task.done()]
+
+    # plays clip from the sound library over anything playing, after is called when it ends.
+    # Returns the track, None if the bot left voice while the clip was loading
+    async def play_clip(self, name, volume, after):
+        clip = await self.sounds.get(name, volume)
+        if self.mixer is None:
+            return None
+        track = self.mixer.clip(clip, after=after)
+        track.start()
+        self.touch()
+        return track
+
+    # rough number of bytes held by songs in the queue and the one playing
+    def memory(self):
+        seen = set()
+        entries = list(self.songs._queue)
+        if self.current is not None:
+            entries.append(self.current)
+        return sum(deep_size(entry.__dict__, seen) for entry in entries)
+
     # When new song changes, send message about next song and play next song in queue
     # waits until songs are finished
     async def audio_player_task(self):
         while True:
             self.play_next_song.clear()
-            self.current = await self.songs.get()
-            await self.bot.send_message(self.current.channel, 'Now playing ' + str(self.current))
+            entry = await self.songs.get()
+            self.song_taken.set()
+            self.prefetch()
+            try:
+                player = await self.resolver.create_player(self.voice, entry, after=self.toggle_next)
+            except Exception as e:
+                # failing first look up was already said when it happened, songs from playlists are looked up late
+                if entry.info is not None or entry.playlist is not None:
+                    fmt = 'Could not play {}: ```py\n{}: {}\n```'
+                    self.bot.outbox.send(entry.channel, fmt.format(entry.title, type(e).__name__, e))
+                continue
+            player.volume = 0.02
+            entry.player = self.mixer.stream(player, music=True)  # played through mixer so sounds can play over it
+            self.current = entry
+            self.bot.outbox.send(self.current.channel, 'Now playing ' + str(self.current), priority=CHATTER)
             self.current.player.start()
-            await self.play_next_song.wait()
+            self.touch()
+            # streams found now may be too old by the time this song ends, so look again shortly before
+            duration = entry.duration
+            refresh = None
+            if duration:
+                refresh = self.bot.loop.call_later(max(0, duration - PREFETCH_BEFORE), self.prefetch)
+            try:
+                await self.play_next_song.wait()
+            finally:
+                if refresh is not None:
+                    refresh.cancel()
+            self.touch()  # idle time is counted from the end of the last song
+
+    # waits until fewer then limit songs are waiting in the queue
+    async def wait_for_room(self, limit):
+        while self.songs.qsize() >= limit:
+            self.song_taken.clear()
+            await self.song_taken.wait()
+
+    # Looks up streams again for the next few songs if they are old, or will be before the song
+    # playing ends, so they are ready when their turn comes
+    def prefetch(self):
+        for entry in itertools.islice(self.songs._queue, PREFETCH_SONGS):
+            self.resolver.refresh(entry, within=PREFETCH_BEFORE)
 
     @player.setter
     def player(self, value):
         self._player = value
 
+    # sets voice client for the state and starts the mixer everything is played through
+    def connect(self, voice):
+        self.voice = voice
+        self.mixer = Mixer(voice)
+        self.mixer.start()
+
+    # stops tasks and everything playing and leaves the voice channel
+    async def close(self):
+        self.clips.close()
+        for task in self.tasks():
+            task.cancel()
+        await self.disconnect()
+
+    # stops everything playing and leaves the voice channel
+    async def disconnect(self):
+        if self.mixer is not None:
+            mixer, self.mixer = self.mixer, None
+            mixer.stop()
+            if self.mixer_stopped is not None:
+                self.mixer_stopped(mixer)
+        if self.voice is not None:
+            voice, self.voice = self.voice, None
+            await voice.disconnect()
+
 
 # Voice related commands. Works in multiple servers at once.
 class Music:
@@ -84,31 +275,132 @@ class Music:
     def __init__(self, bot):
         self.bot = bot
         self.voice_states = {}
+        self.yt_cache = YTCache("ytcache.sqlite3")  # pruned by warm_up once connected
+        self.tracks = TrackCache(os.path.join("sound", "tracks"), bot.loop, max_bytes=TRACK_CACHE_BYTES,
+                                 shared=SHARD_COUNT > 1)
+        self.resolver = TrackResolver(bot.loop, self.yt_cache, self.tracks)
+        # loaded once, quotes are read from memory after and other shards' changes read from the journal
+        self.quote_store = QuoteStore("quotes", shared=SHARD_COUNT > 1)
+        self.quote_pages = {}  # user, None for everyone -> QuotePages for !qlist
+        self.quote_index = QuoteIndex(self.quote_store)  # kept up to date by the store as quotes change
+        self.tts_cache = TTSCache(os.path.join("sound", "tts"), shared=SHARD_COUNT > 1)
+        self.sounds = SoundLibrary("sound", os.path.join("sound", "frames"), bot.loop)
+        self.tts = TTSPipeline(self.tts_cache, bot.loop, workers=TTS_WORKERS, max_in_flight=TTS_MAX_IN_FLIGHT)
+        self.word_lists = WordLists()
+        self.owner_id = OWNER_ID  # looked up once connected if not set
+        self.odds_executor = ThreadPoolExecutor(max_workers=ODDS_WORKERS)
+        self.frames_sent = 0  # by mixers that have stopped, so the totals never go down
+        self.late_frames = 0
+        self.betrayal_sessions = BetrayalSessions(bot.loop, self.betrayal_expired, timeout=BETRAYAL_TIMEOUT)
+        for name, path in WORD_LISTS.items():
+            self.word_lists.register(name, path)
+        self.reaper = bot.loop.create_task(self.reap_idle_states())
+        self.metric_names = register_metrics(self)
+        self.metrics_server = None
+        bot.loop.create_task(self.serve_metrics())
+        self.watchdog = StallWatchdog(bot.loop, threshold=STALL_THRESHOLD)  # catches code blocking the event loop
+        self.watchdog.start()
+        self.warming = None  # task loading the slower parts of the bot once it is connected
 
     # Returns state. Creates state if there is none in server currently.
     def get_voice_state(self, server):
         state = self.voice_states.get(server.id)
         if state is None:
-            state = VoiceState(self.bot)
+            state = VoiceState(self.bot, self.resolver, self.sounds, mixer_stopped=self.mixer_stopped)
             self.voice_states[server.id] = state
         return state
 
+    def mixer_stopped(self, mixer):
+        self.frames_sent += mixer.frames_sent
+        self.late_frames += mixer.late_frames
+
+    # frames sent and frames late by every mixer since the bot started
+    def mixer_totals(self):
+        mixers = [state.mixer for state in self.voice_states.values() if state.mixer is not None]
+        return (self.frames_sent + sum(mixer.frames_sent for mixer in mixers),
+                self.late_frames + sum(mixer.late_frames for mixer in mixers))
+
+    # leaves voice and forgets state of server
+    async def remove_voice_state(self, server_id):
+        state = self.voice_states.pop(server_id, None)
+        if state is not None:
+            await state.close()
+
+    # leaves servers that have played nothing for a while so idle servers hold no tasks or players
+    async def reap_idle_states(self):
+        while True:
+            await asyncio.sleep(REAP_EVERY)
+            for server_id, state in list(self.voice_states.items()):
+                if state.is_idle(IDLE_TIMEOUT):
+                    try:
+                        await self.remove_voice_state(server_id)
+                    except Exception as e:
+                        print("Could not leave idle server {}: {}".format(server_id, e), file=sys.stderr)
+
     # creates a voice client for the state. Joins channel of user who summoned robot
     async def create_voice_client(self, channel):
+        load_opus()  # voice clients need opus, already loaded by warm_up unless voice is used straight away
         voice = await self.bot.join_voice_channel(channel)
         state = self.get_voice_state(channel.server)
-        state.voice = voice
+        state.connect(voice)
+
+    # starts warming up the first time the bot connects
+    async def on_ready(self):
+        if self.warming is None:
+            self.bot.startup.setdefault("ready", time.perf_counter() - STARTED)
+            self.warming = self.bot.loop.create_task(self.warm_up())
+        if self.owner_id is None:
+            try:
+                self.owner_id = (await self.bot.application_info()).owner.id
+            except Exception as e:
+                print("Could not find the owner of the bot: {}".format(e), file=sys.stderr)
+
+    # Loads what the bot started without once it is connected, on a worker thread so commands
+    # are answered meanwhile. Anything used before it is loaded here is loaded when first used
+    async def warm_up(self):
+        for job in (load_opus, load_youtube_dl, load_gtts, self.yt_cache.prune):
+            try:
+                await self.bot.loop.run_in_executor(None, job)
+            except Exception as e:
+                print("Could not warm up {}: {}".format(job.__name__, e), file=sys.stderr)
+        self.bot.startup["warm"] = time.perf_counter() - STARTED
+        print("Ready {ready:.2f}s after starting, of which imports took {import:.2f}s, and warmed up after {warm:.2f}s"
+              .format(**self.bot.startup))
+
+    async def serve_metrics(self):
+        try:
+            self.metrics_server = await metrics.serve(metrics.registry, "127.0.0.1", METRICS_PORT + SHARD_ID)
+        except OSError as e:
+            print("Could not serve metrics on port {}: {}".format(METRICS_PORT + SHARD_ID, e), file=sys.stderr)
+
+    # times every command, the time it started is kept on its context
+    async def on_command(self, command, ctx):
+        ctx.started = time.perf_counter()
+        COMMANDS_RUN.inc(command.name)
+
+    async def on_command_completion(self, command, ctx):
+        if hasattr(ctx, 'started'):
+            COMMAND_SECONDS.observe(time.perf_counter() - ctx.started, command.name)
 
     # Used for cleanup to close everything before unloading.
     # Closes playing songs and disconnects bot
     def __unload(self):
+        self.reaper.cancel()
+        if self.warming is not None:
+            self.warming.cancel()
+        self.watchdog.stop()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        for name in self.metric_names:
+            metrics.registry.remove(name)
         for state in self.voice_states.values():
-            try:
-                state.audio_player.cancel()
-                if state.voice:
-                    self.bot.loop.create_task(state.voice.disconnect())
-            except:
-                pass
+            self.bot.loop.create_task(state.close())
+        self.voice_states = {}
+        self.quote_store.close()
+        self.tts.close()
+        self.odds_executor.shutdown(wait=False)
+        self.yt_cache.close()
+        self.betrayal_sessions.close()
 
 
     # Connects bot to voice channel of user who wrote message to call bot
@@ -117,12 +409,14 @@ class Music:
     async def summon(self, ctx):
         summoned_channel = ctx.message.author.voice_channel
         if summoned_channel is None:
-            await self.bot.say('You are not in a voice channel.')
+            await self.bot.outbox.say(ctx, 'You are not in a voice channel.')
             return False
 
         state = self.get_voice_state(ctx.message.server)
+        state.touch()
         if state.voice is None:  # if currently in no voice channel
-            state.voice = await self.bot.join_voice_channel(summoned_channel)
+            load_opus()
+            state.connect(await self.bot.join_voice_channel(summoned_channel))
         else:
             await state.voice.move_to(summoned_channel)  # move to new voice channel
         return True
@@ -136,12 +430,8 @@ class Music:
     @commands.command(pass_context=True, no_pm=True)
     async def play(self, ctx, *, song: str):
 
-        # gets state to play on and sets parameters for player of music
+        # gets state to play on
         state = self.get_voice_state(ctx.message.server)
-        opts = {
-            'default_search': 'auto',
-            'quiet': True,
-        }
 
         # tries join voice channel if not currently not in one, returns if not successful
         if state.voice is None:
@@ -149,18 +439,29 @@ class Music:
             if not success:
                 return
 
-        try:  # creates player to find and play song on youtube
-            player = await state.voice.create_ytdl_player(song, ytdl_options=opts, after=state.toggle_next,
-                                                          before_options="-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5")
-        except Exception as e:
-            fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-            await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
-        else:
-            # sets volume and adds song to queue
-            player.volume = 0.02
-            entry = VoiceEntry(ctx.message, player)
-            await self.bot.say('Queued ' + str(entry))
-            await state.songs.put(entry)
+        if state.songs.full():
+            await self.bot.outbox.say(ctx, 'The queue is full, wait for some songs to play first')
+            return
+
+        if PLAYLIST_URL.match(song):
+            if state.importing is not None and not state.importing.done():
+                await self.bot.outbox.say(ctx, 'Still queueing the last playlist, wait for it or use !stop')
+                return
+            try:
+                playlist = await self.resolver.open_playlist(song)
+            except Exception as e:
+                fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
+                await self.bot.outbox.say(ctx, fmt.format(type(e).__name__, e))
+                return
+            if playlist is not None:
+                state.importing = self.bot.loop.create_task(queue_playlist(self, ctx, state, *playlist))
+                return
+
+        # queues song straight away and looks it up on youtube in the background
+        entry = VoiceEntry(ctx.message, song)
+        self.resolver.resolve(entry).add_done_callback(functools.partial(report_lookup_error, self, entry))
+        await state.enqueue(entry)
+        await self.bot.outbox.say(ctx, 'Queued ' + str(entry))
 
     # Writes to chat volume of song if only !vol used, if number out after !vol sets volume to that value  "
     @commands.command(pass_context=True, no_pm=True)
@@ -169,16 +470,16 @@ class Music:
         if state.is_playing():
             player = state.player
             if len(newvol) < 1:  # if only !vol typed
-                await self.bot.say('Song volume is {:.0%}'.format(player.volume))
+                await self.bot.outbox.say(ctx, 'Song volume is {:.0%}'.format(player.volume))
             else:
                 try:
                     value = int(newvol[0])
                     player.volume = value / 100
-                    await self.bot.say('Set the volume to {:.0%}'.format(player.volume))
+                    await self.bot.outbox.say(ctx, 'Set the volume to {:.0%}'.format(player.volume))
                 except:  # if value after !val was not a number
-                    await self.bot.say("Enter a number after !vol to change the volume ")
+                    await self.bot.outbox.say(ctx, "Enter a number after !vol to change the volume ")
         else:
-            await self.bot.say("No song is currently playing")
+            await self.bot.outbox.say(ctx, "No song is currently playing")
 
     # Pauses the currently played song.
     @commands.command(pass_context=True, no_pm=True)
@@ -207,9 +508,7 @@ class Music:
             player = state.player
             player.stop()
         try:
-            state.audio_player.cancel()
-            del self.voice_states[server.id]
-            await state.voice.disconnect()
+            await self.remove_voice_state(server.id)
         except:
             pass
 
@@ -218,118 +517,101 @@ class Music:
     async def skip(self, ctx):
         state = self.get_voice_state(ctx.message.server)
         if not state.is_playing():
-            await self.bot.say('Not playing any music right now...')
+            await self.bot.outbox.say(ctx, 'Not playing any music right now...')
             return
         state.skip()
-        await self.bot.say('Skipping song...')
+        await self.bot.outbox.say(ctx, 'Skipping song...')
 
     # show info on correctly playing song
     @commands.command(pass_context=True, no_pm=True)
     async def playing(self, ctx):
         state = self.get_voice_state(ctx.message.server)
         if state.current is None:
-            await self.bot.say('Not playing anything.')
+            await self.bot.outbox.say(ctx, 'Not playing anything.')
         else:
-            await self.bot.say('Now playing {}'.format(state.current))
+            await self.bot.outbox.say(ctx, 'Now playing {}'.format(state.current))
 
     # flips a random coin
     @commands.command(pass_context=True, no_pm=True)
-    async def flip(self):
+    async def flip(self, ctx):
         flip = random.choice(['Heads', 'Tails'])
-        await self.bot.say(flip)
+        await self.bot.outbox.say(ctx, flip)
 
-    # Used to setup text for Betrayal at house on the hill
+    # Used to setup text for Betrayal at house on the hill.
+    # Players pick their characters in turn by reacting to the list of characters
     @commands.command(pass_context=True, no_pm=True)
     async def betrayal(self, ctx, players: int):
-
-        # Holds all the possible characters
-        characters = (BetrayalPlayer("Madame Zostra", 4, 3, 4, 4), BetrayalPlayer("Vivian Lopez", 2, 4, 4, 5),
-                      BetrayalPlayer("Darrin 'Flash' Williams", 3, 6, 3, 3), BetrayalPlayer("Ox Bellows", 5, 4, 3, 3),
-                      BetrayalPlayer("Brandon Jaspers", 4, 4, 4, 3), BetrayalPlayer("Peter Akimoto", 3, 4, 4, 4),
-                      BetrayalPlayer("Heather Granville", 3, 4, 3, 5), BetrayalPlayer("Jenny LeClerc", 4, 4, 4, 3),
-                      BetrayalPlayer("Zoe Ingstrom", 3, 4, 5, 3), BetrayalPlayer("Missy Dubourde", 3, 5, 3, 4),
-                      BetrayalPlayer("Professor Longfellow", 3, 4, 3, 5),
-                      BetrayalPlayer("Father Rhinehardt", 2, 3, 6, 4))
+        if players <= 0:  # if no number given
+            await self.bot.outbox.say(ctx, "Must end with number greater then 0")
+            return
+        elif players > MAX_PLAYERS:
+            await self.bot.outbox.say(ctx, "Must end with number below {}".format(MAX_PLAYERS + 1))
+            return
+        session = self.betrayal_sessions.start(ctx.message.channel, players)
+        if session is None:
+            await self.bot.outbox.say(ctx, "A game is already being set up in this channel")
+            return
+        message = await self.bot.outbox.say(ctx, session.roster(), join=False)
+        if message is None:
+            self.betrayal_sessions.end(session)
+            return
+        self.betrayal_sessions.attach(session, message)
         try:
-            if players <= 0:  # if no number given
-                await self.bot.say("Must end with number greater then 0")
-                return
-            elif players > 8:
-                await self.bot.say("Must end with number below 9")
-                return
-        except ValueError:  # if non-number given
-            await self.bot.say("Must end with number below 9")
+            for emoji in PICK_EMOJI:
+                if self.betrayal_sessions.find(message.id) is not session:
+                    break  # game ended while the reactions were being added
+                await self.bot.add_reaction(message, emoji)
+        except discord.HTTPException:
+            if self.betrayal_sessions.end(session):
+                await self.bot.outbox.say(ctx, "I need to be able to add reactions to set up Betrayal")
+
+    # picks a character for a betrayal game being set up, found by the message reacted to
+    async def on_reaction_add(self, reaction, user):
+        session = self.betrayal_sessions.find(reaction.message.id)
+        if session is None or user == self.bot.user:
+            return
+        index = PICKS.get(reaction.emoji)
+        if index is None:
+            return
+        problem = session.pick(index)
+        if problem is not None:
+            await self.bot.outbox.send(session.channel, problem)
+            return
+        if session.done:
+            self.betrayal_sessions.end(session)
+            await self.bot.edit_message(session.message, session.roster())
+            await self.bot.outbox.send(session.channel, session.summary())
             return
-        final_statment = ""
-        characters_chosen = []
+        self.betrayal_sessions.wait(session)
+        await self.bot.edit_message(session.message, session.roster())
 
-        # checks character chosen so if it is a valid choice
-        def character_check(inp):
-            try:
-                inp = int(inp.content)
-                if inp in characters_chosen:
-                    self.bot.say("Character has already been chosen")
-                    return False
-                if inp % 2 == 0:  # if even character number
-                    if inp - 1 in characters_chosen:  # if characters same colour chosen
-                        self.bot.say("Character with the same color has already been chosen")
-                        return False
-                    else:
-                        characters_chosen.append(inp)
-                        return inp
-                elif inp % 2 == 1:  # if odd character number given
-                    if inp + 1 in characters_chosen:  # if characters same colour chosen
-                        self.bot.say("Character with the same color has already been chosen")
-                        return False
-                    else:
-                        characters_chosen.append(inp)
-                        return inp
-                else:  # if number not a character number
-                    self.bot.say("Incorrect number given")
-                    return False
-            except ValueError:  # not a integer number
-                self.bot.say("Incorrect input given")
-                return False
-
-        characters_string = ""
-        for j in range(0, len(characters)):  # for the number of players
-            characters_string += characters[j].name + ": " + str(j + 1) + "\n"
-        characters_string.strip()
-        await self.bot.say(characters_string)
-        for i in range(players):
-            await self.bot.say("Enter character number for player " + str(i + 1))
-            value = await bot.wait_for_message(timeout=15, check=character_check)
-            if value is None:
-                await self.bot.say("No value given. Exiting...")
-                return
-            value = int(value.content) - 1
-            final_statment += "\n" + str(characters[value])
-            final_statment += "\n"
-            final_statment.strip()
-            characters_chosen.append(value)
-        await self.bot.say(final_statment)
+    # betrayal game nobody picked a character in for a while
+    def betrayal_expired(self, session):
+        self.bot.outbox.send(session.channel, "No character chosen. Exiting...")
 
-    # Used to roll multiple values of dice"
+    # Rolls dice written like 2d6, 4d6kh3+2d8+5 (keep highest 3), 4d6dl1 (drop lowest) or 3d10! (exploding).
+    # Big rolls are summarised instead of writing out every die
     @commands.command(pass_context=True, no_pm=True)
-    async def roll(self, ctx, value: str):
+    async def roll(self, ctx, *, value: str):
+        try:
+            terms = dice.parse(value)
+        except dice.DiceError as e:
+            await self.bot.outbox.say(ctx, "{}. Rolls look like 2d6, 4d6kh3+2d8+5 or 3d10!".format(e))
+            return
+        await self.bot.outbox.say(ctx, dice.roll(terms).describe())
 
-        rolls = limit = 0
+    # Works out the exact chance of a roll, like !odds 10d6 >= 35 or !odds 4d6kh3 > 15.
+    # Without a comparison the mean, spread and most likely total are given. Big pools take a
+    # moment the first time so they are worked out on threads of their own, off the event loop
+    # and away from the default executor voice and song lookups use
+    @commands.command(pass_context=True, no_pm=True)
+    async def odds(self, ctx, *, value: str):
         try:
-            rolls, limit = map(int, value.split('d'))
-            if rolls < 1 or limit < 1:
-                return
-        except (TypeError, IndexError, ValueError):
-            await bot.say("Format has to be in NdN!")
-        total = 0
-        result = ""
-        for r in range(rolls):
-            rand = random.randint(1, limit)
-            total += rand
-            result += str(rand) + " + "
-        result = result[: -2]
-        if rolls > 1:
-            result += " = " + str(total)
-        await bot.say(result)
+            text = await self.bot.loop.run_in_executor(self.odds_executor, odds.answer, value)
+        except dice.DiceError as e:
+            await self.bot.outbox.say(ctx, "{}. Ask like !odds 10d6 >= 35 or !odds 4d6kh3".format(e))
+            return
+        await self.bot.outbox.say(ctx, text)
 
     # plays lucio soundclip
     @commands.command(pass_context=True, no_pm=True)
@@ -339,7 +621,7 @@ class Music:
     # plays omen soundclip"
     @commands.command(pass_context=True, no_pm=True)
     async def omen(self, ctx):
-        await bot.say("It's a Omen!")
+        await self.bot.outbox.say(ctx, "It's a Omen!")
         await play_sound(self, ctx, "omen.mp3", 0.02)
 
     # plays dva soundclip
@@ -377,138 +659,74 @@ class Music:
     async def no(self, ctx):
         await play_sound(self, ctx, "Hotel Mario  No.mp3", 0.04)
 
-    # Opens file and writes 3 random lines from file
-    @commands.command(pass_context=True, no_pm=True)
-    async def fmk(self, ctx, ):
-        file_name = "fmk.txt"
-        file = open(file_name, 'r')
-        names = file.read().splitlines()
-        chosen_names = random.sample(names, 3)
-        await bot.say("{}, {} and {}".format(chosen_names[0], chosen_names[1], chosen_names[2]))
-        file.close()
-
-    # Opens file and writes 3 random lines from file"""
-    @commands.command(pass_context=True, no_pm=True)
-    async def fmkg(self, ctx, ):
-        file_name = "fmk girl.txt"
-        file = open(file_name, 'r')
-        names = file.read().splitlines()
-        chosen_names = random.sample(names, 3)
-        await bot.say("{}, {} and {}".format(chosen_names[0], chosen_names[1], chosen_names[2]))
-        file.close()
-
-    # Opens file and writes 3 random lines from file
-    @commands.command(pass_context=True, no_pm=True)
-    async def fmkb(self, ctx, ):
-        file_name = "fmk boy.txt"
-        file = open(file_name, 'r')
-        names = file.read().splitlines()
-        chosen_names = random.sample(names, 3)
-        await bot.say("{}, {} and {}".format(chosen_names[0], chosen_names[1], chosen_names[2]))
-        file.close()
-
-    # Opens file and writes 3 random lines from file
-    @commands.command(pass_context=True, no_pm=True)
-    async def fmkd(self, ctx, ):
-        file_name = "fmkd"
-        file = open(file_name, 'r')
-        names = file.read().splitlines()
-        chosen_names = random.sample(names, 3)
-        await bot.say("{}, {} and {}".format(chosen_names[0], chosen_names[1], chosen_names[2]))
-        file.close()
-
     # says the message sound in tts
     @commands.command(pass_context=True, no_pm=True)
     async def say(self, ctx, *, message: str):
-        tts = gTTS(text=message, lang='en-uk')
-        say_lock.acquire()
-        try:
-            tts.save("sound/say.mp3")
-            await play_sound(self, ctx, "say.mp3", 0.1)
-        finally:
-            say_lock.release()
+        await say_tts(self, ctx, message, 'en-uk')
 
     # says the message sound in tts but slower
     @commands.command(pass_context=True, no_pm=True)
     async def slow(self, ctx, *, message: str):
-        tts = gTTS(text=message, lang='en-uk', slow=True)
-        say_lock.acquire()
-        try:
-            tts.save("sound/say.mp3")
-            await play_sound(self, ctx, "say.mp3", 0.1)
-        finally:
-            say_lock.release()
+        await say_tts(self, ctx, message, 'en-uk', slow=True)
 
     # Says the text in user message using the japanese tts
     @commands.command(pass_context=True, no_pm=True)
     async def jap(self, ctx, *, message: str):
-        tts = gTTS(text=message, lang='ja')
-        say_lock.acquire()
-        try:
-            tts.save("sound/say.mp3")
-            await play_sound(self, ctx, "say.mp3", 0.1)
-        finally:
-            say_lock.release()
+        await say_tts(self, ctx, message, 'ja')
 
-    # Cleans up channel by removing old bot messages
+    # Cleans up channel by removing bot messages and commands under 14 days old.
+    # Deletes straight from the message index, history is only read for messages from before it
     @commands.command(pass_context=True, no_pm=True)
     async def cleanup(self, ctx):
         channel = ctx.message.channel
         try:
-            deleted = await bot.purge_from(channel, limit=100, check=is_not_clean, after=datetime.datetime.now(
-            ) - datetime.timedelta(days=13))
-            await bot.send_message(channel, 'Deleted {} message(s)'.format(len(deleted)))
-        except discord.HTTPException:
-            await bot.say("You can't delete messages older then 14 days ")
+            deleted = await clean_channel(self, channel)
         except discord.Forbidden:
-            await bot.say("Need extra permissions to clean up")
+            await self.bot.outbox.say(ctx, "Need extra permissions to clean up")
+            return
+        except discord.HTTPException as e:
+            await self.bot.outbox.say(ctx, "Could not clean up: {}".format(e))
+            return
+        await self.bot.outbox.send(channel, 'Deleted {} message(s)'.format(deleted))
+
+    # adds commands to the message index so !cleanup can find them
+    async def on_message(self, message):
+        if message.content.startswith("!"):
+            self.bot.message_index.add(message.channel.id, message.id)
+
+    async def on_message_delete(self, message):
+        self.bot.message_index.discard(message.channel.id, message.id)
 
     # used for getting or adding quotes of users saved
     @commands.command(pass_context=True, no_pm=True)
     async def quote(self, ctx):
-        quote_name = "quotes"
-        quote_file = open(quote_name, 'rb')
-        quotes = pickle.load(quote_file)
-        quote_file.close()
-
+        quotes = self.quote_store
         try:
-            quote_file = open(quote_name, "wb")
             message = ctx.message.content
             message = message.strip()
             message = re.sub(' +', ' ', message)  # removes all spaces to one
             message = message.split(" ")
             if len(message) == 1:  # if only !quote select random quote and return it
-                user = random.choice(list(quotes))
-                user_quotes = quotes[user]
-                quote = random.choice(user_quotes)
+                user, quote = quotes.random_quote()
                 await say_quote(self, ctx, user, quote)
             elif len(message) == 2:  # if !quote then name of user
                 user = message[1]
-                if user.lower() not in quotes:  # if user not found
-                    await bot.say("{} does not have any quotes".format(user.capitalize()))
+                if user not in quotes:  # if user not found
+                    await self.bot.outbox.say(ctx, "{} does not have any quotes".format(user.capitalize()))
                 else:  # if user has quotes
-                    user_quotes = quotes[user.lower()]
-                    quote = random.choice(user_quotes)
+                    _, quote = quotes.random_quote(user)
                     await say_quote(self, ctx, user, quote)
             else:  # if !quote, name of user then quote
                 user = message[1]
-                quote = ""
-                for i in range(2, len(message)):
-                    quote += " " + message[i]
-                quote = quote.strip()
+                quote = " ".join(message[2:])
                 quote = quote[:1].upper() + quote[1:]
-                if user.lower() not in quotes:  # if first quote for that user
-                    quotes[user.lower()] = [quote]
-                    await bot.say("There is now quotes for {}".format(user.capitalize()))
+                if quotes.add(user, quote):  # if first quote for that user
+                    await self.bot.outbox.say(ctx, "There is now quotes for {}".format(user.capitalize()))
                 else:  # if user had quotes before
-                    quotes[user.lower()].append(quote)
-                    await bot.say("Added quote for {}".format(user.capitalize()))
+                    await self.bot.outbox.say(ctx, "Added quote for {}".format(user.capitalize()))
         except Exception as e:
             fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-            await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
-        finally:
-            pickle.dump(quotes, quote_file)
-            quote_file.close()
+            await self.bot.outbox.send(ctx.message.channel, fmt.format(type(e).__name__, e))
 
     """
     Deletes quotes stored. If only name supplied after quoted, deletes all quotes stored that name has.
@@ -517,162 +735,235 @@ class Music:
     """
     @commands.command(pass_context=True, no_pm=True)
     async def quoted(self, ctx):
-        quote_name = "quotes"
-        quote_file = open(quote_name, 'rb')
-        quotes = pickle.load(quote_file)
-        quote_file.close()
-
+        quotes = self.quote_store
         try:
-            quote_file = open(quote_name, "wb")
             message = ctx.message.content
             message = message.strip()
             message = re.sub(' +', ' ', message)  # removes all spaces to one
             message = message.split(" ")
             if len(message) == 1:  # if only !quoted typed
-                await bot.say("Please enter a name after to delete that name's quotes")
+                await self.bot.outbox.say(ctx, "Please enter a name after to delete that name's quotes")
             elif len(message) == 2:  # if only quoted then name of user
                 user = message[1]
-                if user.lower() not in quotes:  # if name user has no quotes
-                    await bot.say("{} does not have any quotes".format(user.capitalize()))
+                if user not in quotes:  # if name user has no quotes
+                    await self.bot.outbox.say(ctx, "{} does not have any quotes".format(user.capitalize()))
                 else:  # delete all quotes for that user
-                    quotes.pop(user.lower(), None)
-                    await bot.say("Quotes for {} have been deleted".format(user.capitalize()))
+                    quotes.remove_user(user)
+                    await self.bot.outbox.say(ctx, "Quotes for {} have been deleted".format(user.capitalize()))
             else:  # if user name given and specific quote
                 user = message[1]
-                quote = ""
-                for i in range(2, len(message)):
-                    quote += " " + message[i]
-                quote = quote.strip()
+                quote = " ".join(message[2:])
                 quote = quote[:1].upper() + quote[1:]
-                if user.lower() not in quotes:  # if user does not have any quotes
-                    await bot.say("{} does not have any quotes".format(user.capitalize()))
+                if user not in quotes:  # if user does not have any quotes
+                    await self.bot.outbox.say(ctx, "{} does not have any quotes".format(user.capitalize()))
+                elif quote not in quotes.get(user):  # if user does not have specific quote in message
+                    await self.bot.outbox.say(ctx, "{} does not have that quote".format(user.capitalize()))
+                elif quotes.remove(user, quote):  # if that was the last quote for the user
+                    await self.bot.outbox.say(ctx, "Quotes for {} have been deleted".format(user.capitalize()))
                 else:
-                    user_quotes = quotes[user.lower()]
-                    if quote not in user_quotes:  # if user does not have specific quote in message
-                        await bot.say("{} does not have that quote".format(user.capitalize()))
-                    else:
-                        quotes[user.lower()].remove(quote)
-                        if len(user_quotes) == 0:
-                            quotes.pop(user.lower(), None)
-                            await bot.say("Quotes for {} have been deleted".format(user.capitalize()))
-                        else:
-                            await bot.say("Quote removed from {}".format(user.capitalize()))
+                    await self.bot.outbox.say(ctx, "Quote removed from {}".format(user.capitalize()))
         except Exception as e:
             fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-            await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
-        finally:
-            pickle.dump(quotes, quote_file)
-            quote_file.close()
+            await self.bot.outbox.send(ctx.message.channel, fmt.format(type(e).__name__, e))
 
     # same as quote but tts reads quote
     @commands.command(pass_context=True, no_pm=True)
     async def quotes(self, ctx):
-        quote_name = "quotes"
-        quote_file = open(quote_name, 'rb')
-        quotes = pickle.load(quote_file)
-        quote_file.close()
-
+        quotes = self.quote_store
         try:
-            quote_file = open(quote_name, "wb")
             message = ctx.message.content
             message = message.strip()
             message = re.sub(' +', ' ', message)  # removes all spaces to one
             message = message.split(" ")
             if len(message) == 1:
-                user = random.choice(list(quotes))
-                user_quotes = quotes[user]
-                quote = random.choice(user_quotes)
+                user, quote = quotes.random_quote()
                 await say_quote_sound(self, ctx, user, quote)
             elif len(message) == 2:
                 user = message[1]
-                if user.lower() not in quotes:
-                    await bot.say("{} does not have any quotes".format(user.capitalize()))
+                if user not in quotes:
+                    await self.bot.outbox.say(ctx, "{} does not have any quotes".format(user.capitalize()))
                 else:
-                    user_quotes = quotes[user.lower()]
-                    quote = random.choice(user_quotes)
+                    _, quote = quotes.random_quote(user)
                     await say_quote_sound(self, ctx, user, quote)
             else:
                 user = message[1]
-                quote = ""
-                for i in range(2, len(message)):
-                    quote += " " + message[i]
-                quote = quote.strip()
-                quote[:1].upper()
-                if user.lower() not in quotes:
-                    quotes[user.lower()] = [quote]
-                    await bot.say("There is now quotes for {}".format(user.capitalize()))
+                quote = " ".join(message[2:])
+                if quotes.add(user, quote):
+                    await self.bot.outbox.say(ctx, "There is now quotes for {}".format(user.capitalize()))
                 else:
-                    quotes[user.lower()].append(quote)
-                    await bot.say("Added quote for {}".format(user.capitalize()))
+                    await self.bot.outbox.say(ctx, "Added quote for {}".format(user.capitalize()))
         except Exception as e:
             fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-            await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
-        finally:
-            pickle.dump(quotes, quote_file)
-            quote_file.close()
+            await self.bot.outbox.send(ctx.message.channel, fmt.format(type(e).__name__, e))
 
     # Returns the number quotes stored for each person that has quotes
     @commands.command(pass_context=True, no_pm=True)
-    async def qcheck(self):
-        quote_name = "quotes"
-        quote_file = open(quote_name, 'rb')
-        quotes = pickle.load(quote_file)
+    async def qcheck(self, ctx):
         reply = ""
-        for user in quotes:
-            reply += "{}: {}\n".format(user.capitalize(), len(quotes[user]))
-        await bot.say(reply)
-        quote_file.close()
+        for user, count in self.quote_store.counts():
+            reply += "{}: {}\n".format(user.capitalize(), count)
+        await self.bot.outbox.say(ctx, reply)
 
-    # Returns all quotes stored with the user who said them
+    """
+    Shows a page of quotes stored with the user who said them. !qlist shows everyone's quotes,
+    !qlist name shows that person's. A page number can be put at the end, and the arrows
+    under the message move between pages
+    """
     @commands.command(pass_context=True, no_pm=True)
     async def qlist(self, ctx):
-        quote_name = "quotes"
-        quote_file = open(quote_name, 'rb')
-        quotes = pickle.load(quote_file)
+        quotes = self.quote_store
         try:
             message = ctx.message.content
             message = message.strip()
             message = re.sub(' +', ' ', message)  # removes all spaces to one
-            message = message.split(" ")
-            if len(message) == 1:
-                reply = ""
-                for user in quotes:
-                    reply += "\n{}:\n".format(user.capitalize())
-                    for quote in quotes[user.lower()]:
-                        reply += "{}\n".format(quote)
-                try:
-                    await bot.say(reply)
-                except discord.HTTPException:
-                    n = 2000
-                    replys = [reply[i:i + n] for i in range(0, len(reply), n)]
-                    for reply in replys:
-                        await bot.say(reply)
-            elif len(message) == 2:
-                user = message[1]
-                if user.lower() not in quotes:
-                    await bot.say("{} does not have any quotes".format(user.capitalize()))
-                else:
-                    user_quotes = quotes[user.lower()]
-                    reply = "{}:\n".format(user.capitalize())
-                    for quote in user_quotes:
-                        reply += "{}\n".format(quote)
-                    await bot.say(reply)
-            else:
-                await bot.say("Enter only a name after !qlist to see that person's quotes")
+            message = message.split(" ")[1:]
+            page = 1
+            if message and message[-1].isdigit():  # if page number given
+                page = int(message.pop())
+            if len(message) > 1:
+                await self.bot.outbox.say(ctx, "Enter only a name and page after !qlist to see that person's quotes")
+                return
+            user = message[0].lower() if message else None
+            if user is not None and user not in quotes:
+                await self.bot.outbox.say(ctx, "{} does not have any quotes".format(user.capitalize()))
+                return
+            pages = self.quote_pages.get(user)
+            if pages is None:
+                pages = self.quote_pages[user] = QuotePages(quotes, user)
+            await show_quote_page(self, ctx, pages, page - 1)
         except Exception as e:
             fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-            await self.bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
-        finally:
-            quote_file.close()
+            await self.bot.outbox.send(ctx.message.channel, fmt.format(type(e).__name__, e))
+
+    # finds quotes containing the words after !qsearch, also matches starts of words and small typos
+    @commands.command(pass_context=True, no_pm=True)
+    async def qsearch(self, ctx, *, terms: str):
+        self.quote_store.sync()  # index is told about quotes added by other shards
+        found, total = self.quote_index.search(terms)
+        if not found:
+            await self.bot.outbox.say(ctx, "No quotes found")
+            return
+        reply = ""
+        for user, quote in found:
+            line = "***'{}'*** *- {}*\n".format(quote, user.capitalize())
+            if len(reply) + len(line) > 1900:
+                break
+            reply += line
+        if total > len(found):
+            reply += "and {} more".format(total - len(found))
+        await self.bot.outbox.say(ctx, reply, join=False)
 
     # removes all quotes stored
     @commands.command(pass_context=True, no_pm=True)
-    async def resetpickle(self):
-        quote_name = "quotes"
-        quote_file = open(quote_name, 'wb')
-        pickle.dump({}, quote_file)
-        quote_file.close()
+    async def resetpickle(self, ctx):
+        self.quote_store.reset()
+
+
+    """
+    Shows how often songs are found in the youtube-dl cache. !ytcache purge empties the cache,
+    !ytcache purge followed by a search or url removes only the song it found
+    """
+    @commands.command(pass_context=True, no_pm=True)
+    async def ytcache(self, ctx, *args):
+        if not is_admin(ctx.message.author, self.owner_id):
+            await self.bot.outbox.say(ctx, "Only admins can use !ytcache")
+            return
+        cache = self.yt_cache
+        if not args:
+            size = await self.bot.loop.run_in_executor(None, cache.size)
+            lookups = cache.hits + cache.partial_hits + cache.misses
+            fmt = "{} songs cached. {} lookups, {:.0%} found with a stream, {} needed a new stream, {} missed"
+            await self.bot.outbox.say(ctx, fmt.format(size, lookups, cache.hit_rate(), cache.partial_hits, cache.misses))
+            tracks = self.tracks
+            fmt = "{} songs saved to disk using {:.1f} MB, {:.0%} of songs played from disk, {} being saved"
+            await self.bot.outbox.say(ctx, fmt.format(len(tracks.entries), tracks.size / 1024 / 1024,
+                                                      tracks.hit_rate(), len(tracks.transcoding)))
+        elif args[0] == "purge":
+            query = " ".join(args[1:]) or None
+            removed = await self.bot.loop.run_in_executor(None, cache.purge, query)
+            await self.bot.outbox.say(ctx, "Removed {} song(s) from the cache".format(removed))
+        else:
+            await self.bot.outbox.say(ctx, "Use !ytcache, or !ytcache purge to empty it")
+
+    # Shows voice states held for each server, the tasks they run and roughly how much memory
+    # their queues hold, biggest first, so growth in servers that are not playing shows up
+    @commands.command(pass_context=True, no_pm=True)
+    async def voicestates(self, ctx):
+        if not is_admin(ctx.message.author, self.owner_id):
+            await self.bot.outbox.say(ctx, "Only admins can use !voicestates")
+            return
+        now = time.monotonic()
+        states = sorted(self.voice_states.items(), key=lambda item: item[1].memory(), reverse=True)
+        all_tasks = asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks
+        fmt = "{} voice states, {} in voice, {} tasks running for them, {} tasks in total"
+        reply = fmt.format(len(states), sum(state.voice is not None for _, state in states),
+                           sum(len(state.tasks()) for _, state in states), len(all_tasks()))
+        for server_id, state in states[:15]:
+            server = self.bot.get_server(server_id)
+            fmt = "\n{}: {} songs queued, {} tasks, {:.1f} KB, idle {:.0f}s"
+            reply += fmt.format(server.name if server else server_id, state.songs.qsize(), len(state.tasks()),
+                                state.memory() / 1024, now - state.last_active)
+        await self.bot.outbox.say(ctx, reply, join=False)
+
+    # Shows how many times each command was used and how long it takes, with the state of
+    # the queues and caches the same as the metrics endpoint has
+    @commands.command(pass_context=True, no_pm=True)
+    async def stats(self, ctx):
+        if not is_admin(ctx.message.author, self.owner_id):
+            await self.bot.outbox.say(ctx, "Only admins can use !stats")
+            return
+        reply = "```\n{:<12}{:>8}{:>10}{:>10}\n".format("command", "uses", "mean", "p95")
+        for (name,), uses in sorted(COMMANDS_RUN.values.items(), key=lambda item: -item[1])[:15]:
+            count, total, (p95,) = COMMAND_SECONDS.summary((name,), 0.95)
+            mean = total / count if count else 0.0
+            if not count:
+                p95 = "-"
+            elif p95 == float('inf'):
+                p95 = ">{}s".format(COMMAND_SECONDS.buckets[-1])
+            else:
+                p95 = "<{}s".format(p95)
+            reply += "{:<12}{:>8.0f}{:>9.3f}s{:>10}\n".format(name, uses, mean, p95)
+        reply += "```"
+        states = list(self.voice_states.values())
+        mixers = [state.mixer for state in states if state.mixer is not None]
+        outbox = self.bot.outbox
+        frames_sent, late_frames = self.mixer_totals()
+        reply += "Voice: {} connected, {} songs queued, {} late frames of {} sent\n".format(
+            len(mixers), sum(state.songs.qsize() for state in states), late_frames, frames_sent)
+        reply += "TTS: {} waiting, {} synthesising\n".format(self.tts.queue_depth(), self.tts.in_flight)
+        reply += "Caches: tts {:.0%}, youtube-dl {:.0%}, songs on disk {:.0%} hit rate\n".format(
+            self.tts_cache.hit_rate(), self.yt_cache.hit_rate(), self.tracks.hit_rate())
+        p50, p99 = outbox.latency_percentiles(50, 99)
+        reply += "Outbox: {} waiting, {} sent, {} dropped, p50 {:.2f}s p99 {:.2f}s".format(
+            outbox.depth(), outbox.sent, outbox.dropped, p50, p99)
+        await self.bot.outbox.say(ctx, reply, join=False)
 
+    """
+    Shows the longest times the event loop was blocked and the code that was running.
+    !stalls recent shows the latest instead, !stalls clear forgets them
+    """
+    @commands.command(pass_context=True, no_pm=True)
+    async def stalls(self, ctx, which: str = "worst"):
+        if not is_admin(ctx.message.author, self.owner_id):
+            await self.bot.outbox.say(ctx, "Only admins can use !stalls")
+            return
+        if which == "clear":
+            self.watchdog.clear()
+            await self.bot.outbox.say(ctx, "Forgot every stall")
+            return
+        stalls = list(reversed(self.watchdog.recent)) if which == "recent" else self.watchdog.worst
+        if not stalls:
+            await self.bot.outbox.say(ctx, "The event loop has not been blocked for over {}s".format(STALL_THRESHOLD))
+            return
+        for stall in stalls[:3]:
+            reply = "Blocked for {:.3f}s at {:%H:%M:%S}".format(stall.duration, stall.when)
+            if stall.stack is None:
+                reply += ", ended before its stack could be taken"
+            else:
+                reply += ", stack seen in {} of {} samples:\n".format(stall.caught, stall.samples)
+                stack = "\n".join(stall.stack)
+                reply += "```py\n{}\n```".format(stack[-(1900 - len(reply)):])
+            await self.bot.outbox.say(ctx, reply, join=False)
 
     # Used to mke bot write into chat
     @commands.command(pass_context=True, no_pm=True)
@@ -681,69 +972,306 @@ class Music:
         message_content = message.content.strip()
         split = message_content.split(" ", 1)
         if len(split) != 1:
-            if ctx.message.author.name == "Voids forgotten":
-                await bot.delete_message(message)
-                await bot.say(split[1])
+            if self.owner_id is not None and ctx.message.author.id == self.owner_id:
+                await self.bot.delete_message(message)
+                await self.bot.outbox.say(ctx, split[1])
+
+# makes command that writes 3 random lines from the word list registered under name
+def word_list_command(name):
+    async def pick(self, ctx):
+        chosen_names = self.word_lists.sample(name, 3)
+        await self.bot.outbox.say(ctx, "{}, {} and {}".format(chosen_names[0], chosen_names[1], chosen_names[2]))
+    return commands.command(name=name, pass_context=True, no_pm=True)(pick)
+
+for name in WORD_LISTS:
+    setattr(Music, name, word_list_command(name))
+
+# Owner of bot and server admins can use admin commands. The owner is matched by id,
+# names can be taken by anyone
+def is_admin(member, owner_id):
+    if owner_id is not None and member.id == owner_id:
+        return True
+    permissions = getattr(member, 'server_permissions', None)
+    return permissions is not None and permissions.administrator
+
+# Adds metrics read from the state the cog already keeps, returns their names so they can be removed
+def register_metrics(self):
+    def voice_states():
+        return list(self.voice_states.values())
+
+    def mixers():
+        return [state.mixer for state in voice_states() if state.mixer is not None]
+
+    def outbox_latency():
+        p50, p90, p99 = self.bot.outbox.latency_percentiles(50, 90, 99)
+        return {("0.5",): p50, ("0.9",): p90, ("0.99",): p99}
+
+    gauges = [
+        metrics.gauge("jerry_voice_states", "Servers with a voice state", lambda: len(voice_states())),
+        metrics.gauge("jerry_voice_connections", "Servers the bot is in voice in", lambda: len(mixers())),
+        metrics.gauge("jerry_songs_queued", "Songs waiting to play over every server",
+                      lambda: sum(state.songs.qsize() for state in voice_states())),
+        metrics.gauge("jerry_songs_queued_max", "Songs waiting to play in the server with the most",
+                      lambda: max([state.songs.qsize() for state in voice_states()] or [0])),
+        metrics.gauge("jerry_mixer_frames_sent", "Audio frames sent by mixers since the bot started",
+                      lambda: self.mixer_totals()[0], type="counter"),
+        metrics.gauge("jerry_mixer_late_frames", "Audio frames that took longer then 20ms to mix",
+                      lambda: self.mixer_totals()[1], type="counter"),
+        metrics.gauge("jerry_tts_waiting", "TTS requests that have not started synthesising", self.tts.queue_depth),
+        metrics.gauge("jerry_tts_in_flight", "TTS clips being synthesised", lambda: self.tts.in_flight),
+        metrics.gauge("jerry_cache_hit_ratio", "Share of lookups found in each cache",
+                      lambda: {("tts",): self.tts_cache.hit_rate(), ("youtube-dl",): self.yt_cache.hit_rate(),
+                               ("tracks",): self.tracks.hit_rate()}, ("cache",)),
+        metrics.gauge("jerry_outbox_waiting", "Messages waiting to be sent", lambda: self.bot.outbox.depth()),
+        metrics.gauge("jerry_outbox_sent", "Messages sent", lambda: self.bot.outbox.sent, type="counter"),
+        metrics.gauge("jerry_outbox_dropped", "Messages dropped because a channel backed up",
+                      lambda: self.bot.outbox.dropped, type="counter"),
+        metrics.gauge("jerry_outbox_latency_seconds", "Time from a message being queued until it was sent",
+                      outbox_latency, ("quantile",)),
+        metrics.gauge("jerry_startup_seconds", "Time from the process starting until each startup phase ended",
+                      lambda: {(phase,): seconds for phase, seconds in self.bot.startup.items()}, ("phase",)),
+    ]
+    return [gauge.name for gauge in gauges]
+
+# rough size in bytes of obj and everything in it, skipping anything in seen
+def deep_size(obj, seen):
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_size(item, seen) for item in obj)
+    return size
 
 # decides which comments to remove when cleaning up
-def is_not_clean(message):
-    if message.author == bot.user:
+def is_not_clean(message, user):
+    if message.author == user:
         return True
     if message.content.startswith("!"):
         return True
     return False
 
 
-# used to play any sounds in the sound folder when called
-async def play_sound(self, ctx, sound, vol):
+# Deletes bot messages and commands under 14 days old in channel, returns how many were deleted.
+# Indexed messages are bulk deleted 100 at a time. History is read a page at a time only back
+# from where the index starts, and only the first time the channel is cleaned up
+async def clean_channel(self, channel):
+    index = self.bot.message_index
+    oldest = int(time_snowflake(time.time() - BULK_DELETE_AGE))
+    ids = [message_id for message_id in index.messages(channel.id) if int(message_id) > oldest]
+    missing_before = index.missing_before(channel.id)
+    if missing_before is not None and int(missing_before) > oldest:
+        found = set(ids)
+        read = 0
+        reached = False  # got back to messages 14 days old
+        earliest = None  # oldest message read
+        async for message in self.bot.logs_from(channel, limit=HISTORY_LIMIT, before=discord.Object(id=missing_before)):
+            read += 1
+            if int(message.id) <= oldest:
+                reached = True
+                break
+            earliest = message.id
+            if is_not_clean(message, self.bot.user) and message.id not in found:
+                ids.append(message.id)
+        if reached or read < HISTORY_LIMIT:  # nothing left to read, or only messages too old to bulk delete
+            index.filled(channel.id)
+        else:  # stopped at the limit, the rest is read next time
+            index.read_back_to(channel.id, earliest)
+    deleted = 0
+    for start in range(0, len(ids), BULK_DELETE_LIMIT):
+        batch = [MessageRef(message_id, channel) for message_id in ids[start:start + BULK_DELETE_LIMIT]]
+        try:
+            if len(batch) == 1:  # bulk delete needs at least 2 messages
+                await self.bot.delete_message(batch[0])
+            else:
+                await self.bot.delete_messages(batch)
+        except discord.NotFound:  # already deleted
+            pass
+        for message in batch:
+            index.discard(channel.id, message.id)
+        deleted += len(batch)
+    return deleted
+
+
+# Returns state of the server ctx is in, joining the voice channel of the user who asked if the
+# bot is in none. None if it could not join
+async def joined_voice_state(self, ctx):
     state = self.get_voice_state(ctx.message.server)
     if state.voice is None:  # if in no voice channel
         success = await ctx.invoke(self.summon)
         if not success:
-            return
+            return None
+    return state
+
+# Used to play any sounds in the sound folder when called, mixed over any music playing.
+# cached sounds are soundboard clips, encoded once and kept and queued to play one at a time.
+# Use cached=False for sounds only played once, they play straight away
+async def play_sound(self, ctx, sound, vol, cached=True):
+    state = await joined_voice_state(self, ctx)
+    if state is None:
+        return
+    if cached:  # soundboard clip, waits its turn in the server's clip queue
+        result = state.clips.request(ctx.message.author.id, sound, vol)
+        if result == FULL:
+            self.bot.outbox.say(ctx, "Too many sounds are waiting to play", priority=CHATTER)
+        elif result == COOLDOWN:
+            self.bot.outbox.say(ctx, "Wait a moment before playing another sound", priority=CHATTER)
+        state.touch()
+        return
     try:
-        if VoiceState.is_playing(state):  # if currently playing music
-            await self.bot.send_message(ctx.message.channel, "Can't play sounds while music is playing")
-        else:
-            player = state.voice.create_ffmpeg_player("sound/" + sound)
-            player.volume = vol
-            player.start()
+        track = state.mixer.stream(state.voice.create_ffmpeg_player("sound/" + sound), volume=vol)
+        track.start()
+        state.touch()
+        return track
     except Exception as e:
         fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
-        await bot.send_message(ctx.message.channel, fmt.format(type(e).__name__, e))
+        await self.bot.outbox.send(ctx.message.channel, fmt.format(type(e).__name__, e))
+
+# Queues songs from playlist a page at a time. The first song is queued straight away and the rest
+# are only added as songs ahead of them play, so a long playlist never fills the queue
+async def queue_playlist(self, ctx, state, title, entries):
+    queued = 0
+    while queued < PLAYLIST_SONGS:
+        try:
+            urls = await self.resolver.next_entries(entries, min(PLAYLIST_PAGE, PLAYLIST_SONGS - queued))
+        except Exception as e:
+            fmt = 'Stopped reading playlist {}: ```py\n{}: {}\n```'
+            self.bot.outbox.say(ctx, fmt.format(title, type(e).__name__, e), priority=CHATTER)
+            break
+        if not urls:
+            break
+        for url in urls:
+            if queued:  # first song is queued straight away
+                await state.wait_for_room(PLAYLIST_AHEAD)
+            entry = VoiceEntry(ctx.message, url)
+            entry.playlist = title
+            if queued == 0:
+                self.resolver.resolve(entry)
+            await state.enqueue(entry)
+            queued += 1
+            if queued == 1:
+                await self.bot.outbox.say(ctx, 'Queueing playlist *{}*'.format(title))
+    self.bot.outbox.say(ctx, 'Queued {} songs from playlist *{}*'.format(queued, title), priority=CHATTER)
+
+# tells channel song was asked for in if it could not be found
+def report_lookup_error(self, entry, future):
+    if future.cancelled() or future.exception() is None:
+        return
+    e = future.exception()
+    fmt = 'An error occurred while processing this request: ```py\n{}: {}\n```'
+    self.bot.outbox.send(entry.channel, fmt.format(type(e).__name__, e))
+
+# Sends page of quotes, then moves between pages when the arrows under it are pressed
+# until nobody has pressed one for a while
+async def show_quote_page(self, ctx, pages, page):
+    text = pages.page(page)
+    if text is None:
+        await self.bot.outbox.say(ctx, "There is no page {}".format(page + 1) if page else "There are no quotes")
+        return
+    if page == 0 and not pages.has_next(0):  # only one page
+        await self.bot.outbox.say(ctx, text)
+        return
+    message = await self.bot.outbox.say(ctx, "**Page {}**\n{}".format(page + 1, text), join=False)
+    if message is None:
+        return
+    try:
+        await self.bot.add_reaction(message, PREVIOUS_PAGE)
+        await self.bot.add_reaction(message, NEXT_PAGE)
+    except discord.HTTPException:  # can not add reactions, page number can still be given
+        return
+    while True:
+        reaction = await self.bot.wait_for_reaction([PREVIOUS_PAGE, NEXT_PAGE], message=message, timeout=120,
+                                                    check=lambda reaction, user: user != self.bot.user)
+        if reaction is None:  # nobody used the arrows for a while
+            return
+        if reaction.reaction.emoji == NEXT_PAGE and pages.has_next(page):
+            page += 1
+        elif reaction.reaction.emoji == PREVIOUS_PAGE and page > 0:
+            page -= 1
+        text = pages.page(page)
+        if text is None:  # quotes changed under the page shown
+            page = 0
+            text = pages.page(page) or "There are no quotes"
+        try:
+            await self.bot.remove_reaction(message, reaction.reaction.emoji, reaction.user)
+        except discord.HTTPException:  # needs manage messages permission
+            pass
+        await self.bot.edit_message(message, "**Page {}**\n{}".format(page + 1, text))
 
 # writes quotes to chat
 async def say_quote(self, ctx, name, quote):
-    await self.bot.say("***'{}'*** *- {}*".format(quote, name.capitalize()))
+    await self.bot.outbox.say(ctx, "***'{}'*** *- {}*".format(quote, name.capitalize()))
 
 # writes quote to chat and tts reads the quote
 async def say_quote_sound(self, ctx, name, quote):
-    await self.bot.say("***'{}'*** *- {}*".format(quote, name.capitalize()))
+    await self.bot.outbox.say(ctx, "***'{}'*** *- {}*".format(quote, name.capitalize()))
     quote = "{} said {}".format(name, quote)
-    tts = gTTS(text=quote, lang='en-uk')
-    say_lock.acquire()
-    tts.save("sound/say.mp3")
-    await play_sound(self, ctx, "say.mp3", 0.1)
-    say_lock.release()
-
-bot = commands.Bot(command_prefix=commands.when_mentioned_or('!'), description='A playlist example for discord.py')
-bot.add_cog(Music(bot))
-
-# logs details of bot on initialisation
-@bot.event
-async def on_ready():
-    print('Logged in as')
-    print(bot.user.name)
-    print(bot.user.id)
-    print('------')
-
-# welcomes new users to server when they join
-@bot.event
-async def on_member_join(member):
-    server = member.server
-    fmt = 'Welcome {0.mention} to {1.name}!'
-    await bot.send_message(server, fmt.format(member, server))
-
-say_lock = Lock()
-bot.run('MzQ4NzUwMTU3MDY5NjgwNjQw.DHrenA.MNpQVhJEUG27co6rA_Zir8a5u0s')
-
+    await say_tts(self, ctx, quote, 'en-uk')
+
+# plays text in tts, reusing audio already made for the same text. Text with more then one
+# sentence is streamed instead, starting to play once the first sentence is made.
+# Only one tts in a server is made at a time so they play in the order asked
+async def say_tts(self, ctx, text, lang, slow=False):
+    chunks = split_text(text)
+    async with self.tts.server_lock(ctx.message.server.id):
+        if len(chunks) <= 1:
+            path = await self.tts.render(text, lang, slow)
+            await play_sound(self, ctx, os.path.relpath(path, "sound"), 0.1, cached=False)
+            return
+        state = await joined_voice_state(self, ctx)
+        if state is None:
+            return
+        track = state.mixer.pcm(volume=0.1)
+        track.start()
+        state.touch()
+        await self.tts.stream(chunks, lang, slow, track)
+
+IMPORT_SECONDS = time.perf_counter() - STARTED
+
+
+# Makes the bot with its cog, without connecting it
+def make_bot():
+    shard_options = {'shard_id': SHARD_ID, 'shard_count': SHARD_COUNT} if SHARD_COUNT > 1 else {}
+    bot = commands.Bot(command_prefix=commands.when_mentioned_or('!'), description='A playlist example for discord.py',
+                       **shard_options)
+    bot.startup = {"import": IMPORT_SECONDS}  # phase -> seconds from the process starting until it ended
+    bot.message_index = MessageIndex()  # bot messages and commands !cleanup deletes
+    bot.outbox = Outbox(bot, index=bot.message_index)  # every message the bot writes goes through this
+    bot.add_cog(Music(bot))
+
+    # logs details of bot on initialisation
+    @bot.event
+    async def on_ready():
+        print('Logged in as')
+        print(bot.user.name)
+        print(bot.user.id)
+        print('------')
+
+    # welcomes new users to server when they join
+    @bot.event
+    async def on_member_join(member):
+        server = member.server
+        fmt = 'Welcome {0.mention} to {1.name}!'
+        bot.outbox.send(server, fmt.format(member, server), priority=CHATTER)
+
+    return bot
+
+
+# Starts the bot, connecting to discord with the token in JERRY_TOKEN. Opus, youtube-dl and
+# gTTS are loaded after connecting so importing this file does nothing and restarts are quick
+def main():
+    bot = make_bot()
+    if FAKE_GATEWAY:
+        fakegateway.run(bot, SHARD_ID, SHARD_COUNT, FAKE_GATEWAY)
+        return
+    token = os.environ.get("JERRY_TOKEN")
+    if not token:
+        print("Set JERRY_TOKEN to the bot's token", file=sys.stderr)
+        sys.exit(1)
+    bot.run(token)
+
+
+if __name__ == '__main__':
+    main()
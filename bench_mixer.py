@@ -0,0 +1,30 @@
+"""
+Measures how long the mixer takes to mix one 20ms frame as the number of
+sounds playing at once goes up. Everything under 20ms keeps up with discord.
+Run with: python bench_mixer.py [frames]
+"""
+import os
+import statistics
+import sys
+import time
+
+from mixer import mix_frames, DELAY
+from soundlibrary import FRAME_SIZE
+
+
+def main(count):
+    print("{:>8} {:>12} {:>12} {:>10}".format("sources", "median ms", "worst ms", "of budget"))
+    for sources in (1, 2, 4, 8, 16, 32, 64):
+        music = [(0.02, os.urandom(FRAME_SIZE))]
+        others = [(1.0, os.urandom(FRAME_SIZE)) for _ in range(sources - 1)]
+        times = []
+        for i in range(count):
+            start = time.perf_counter()
+            mix_frames(music, others, 1.0 if i % 2 else 0.35, 0.35)  # half the frames ramp the ducking
+            times.append(time.perf_counter() - start)
+        median = statistics.median(times)
+        print("{:>8} {:>12.4f} {:>12.4f} {:>9.1%}".format(sources, median * 1000, max(times) * 1000, median / DELAY))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 2000)
@@ -0,0 +1,349 @@
+"""
+Replays made up traffic through the real Music commands without connecting to discord.
+Sending, reactions and voice are replaced with fakes that count what they are given,
+youtube-dl and gTTS are replaced with delays of about the time they take, everything
+else such as the quote store, sound library and mixer is the real code. Reports commands
+handled a second, latency percentiles of each command and how late the event loop ran,
+and compares them against a saved baseline.
+Run with: python bench_replay.py [--seconds 20] [--concurrency 20] [--save-baseline]
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from collections import defaultdict, namedtuple
+
+from fakegateway import FakeServer, FakeMember, FakeMessage
+from soundlibrary import FRAME_SIZE, FRAME_LENGTH
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(REPO, "bench_baselines.json")
+
+# command -> how often it is sent compared to the others
+DEFAULT_MIX = {"quote": 3, "qlist": 1, "fmk": 3, "roll": 3, "play": 1, "say": 1, "clip": 2}
+CLIPS = ("lucio", "omen", "dva", "tracer", "doomfist", "obi", "objection", "mei", "no")
+WORDS = ("hello", "there", "general", "kenobi", "why", "are", "you", "so", "angry", "cavalry", "here")
+
+YTDL_DELAY = 0.3  # seconds a youtube-dl lookup is made to take
+TTS_DELAY = 0.1  # seconds gTTS is made to take
+SONG_SECONDS = 3  # length of every song played, short so the queues keep moving
+SOUND_SECONDS = 1  # length of tts and uncached sounds played
+
+Reaction = namedtuple('Reaction', 'reaction user')
+Emoji = namedtuple('Emoji', 'emoji')
+
+
+class FakeVoiceChannel:
+    def __init__(self, server):
+        self.id = server.id + "v"
+        self.name = "voice"
+        self.server = server
+
+
+class FakePlayer:
+    """
+    Stands in for the ffmpeg player discord makes, giving silence for seconds
+    """
+
+    def __init__(self, seconds, after):
+        self.buff = io.BytesIO(bytes(FRAME_SIZE * int(seconds * 1000 / FRAME_LENGTH)))
+        self.after = after
+        self.volume = 1.0
+        self.process = None
+        self._current_error = None
+
+    def _call_after(self):
+        if self.after is not None:
+            self.after()
+
+
+class FakeVoice:
+    """
+    Voice client that counts the audio frames the mixer sends it
+    """
+
+    def __init__(self, channel, sink):
+        self.channel = channel
+        self.sink = sink
+        self._connected = threading.Event()
+        self._connected.set()
+
+    def play_audio(self, data, encode=True):
+        self.sink.frames += 1
+
+    def create_ffmpeg_player(self, path, before_options=None, after=None, **kwargs):
+        return FakePlayer(SONG_SECONDS if path.startswith("fake://") else SOUND_SECONDS, after)
+
+    async def move_to(self, channel):
+        self.channel = channel
+
+    async def disconnect(self):
+        self._connected.clear()
+
+
+class Sink:
+    """
+    Replaces everything the bot would send to discord, counting it instead
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.messages = 0
+        self.edits = 0
+        self.frames = 0
+        self.reactions_left = {}  # message id -> page turns still to make
+
+    async def send_message(self, channel, content):
+        self.messages += 1
+        message = FakeMessage(self.bot.user, channel, content)
+        self.reactions_left[message.id] = 2
+        return message
+
+    async def edit_message(self, message, content):
+        self.edits += 1
+        return message
+
+    async def add_reaction(self, message, emoji):
+        pass
+
+    async def remove_reaction(self, message, emoji, user):
+        pass
+
+    # turns a page message forward twice then leaves it, as if the user stopped reading
+    async def wait_for_reaction(self, emoji=None, *, message=None, timeout=None, check=None, **kwargs):
+        if self.reactions_left.get(message.id, 0) == 0:
+            self.reactions_left.pop(message.id, None)
+            return None
+        self.reactions_left[message.id] -= 1
+        await asyncio.sleep(0.05)
+        return Reaction(Emoji(emoji[-1]), FakeMember(message.server, 1))
+
+    async def join_voice_channel(self, channel):
+        return FakeVoice(channel, self)
+
+
+# Copies what the bot reads from the repo into an empty folder so the benchmark does not
+# change the real quotes or caches. Sound clips and word lists are linked, not copied
+def make_workspace():
+    workspace = tempfile.mkdtemp(prefix="jerry-bench-")
+    os.makedirs(os.path.join(workspace, "sound"))
+    for name in os.listdir(os.path.join(REPO, "sound")):
+        path = os.path.join(REPO, "sound", name)
+        if os.path.isfile(path):
+            os.symlink(path, os.path.join(workspace, "sound", name))
+    for name in os.listdir(REPO):
+        if name.endswith(".txt") and name.startswith("fmk"):
+            os.symlink(os.path.join(REPO, name), os.path.join(workspace, name))
+    if os.path.exists(os.path.join(REPO, "quotes")):
+        shutil.copy(os.path.join(REPO, "quotes"), os.path.join(workspace, "quotes"))
+    return workspace
+
+
+def fake_lookup(url):
+    video = str(zlib.crc32(url.encode('utf-8')))
+    return {'id': video, 'extractor': 'fake', 'title': "Song " + url, 'duration': SONG_SECONDS,
+            'url': "fake://" + video, 'webpage_url': "https://example.com/" + video}
+
+
+def fake_render(cache, text, lang, slow):
+    time.sleep(TTS_DELAY)
+    name = cache.key(text, lang, slow) + ".mp3"
+    with open(cache.path(name), 'wb') as file:
+        file.write(b"ID3")
+    return name, 3
+
+
+class Replay:
+    def __init__(self, bot, cog, sink, mix, servers, concurrency, seed):
+        self.bot = bot
+        self.cog = cog
+        self.sink = sink
+        self.concurrency = concurrency
+        self.random = random.Random(seed)
+        self.commands = list(mix)
+        self.weights = [mix[command] for command in self.commands]
+        self.servers = [FakeServer((n + 1) << 22) for n in range(servers)]
+        for server in self.servers:
+            voice_channel = FakeVoiceChannel(server)
+            for member in server.members:
+                member.voice_channel = voice_channel
+        self.latencies = defaultdict(list)  # command -> seconds each took
+        self.errors = 0
+        self.lags = []  # seconds the event loop ran late
+
+    def content(self, command):
+        words = " ".join(self.random.sample(WORDS, 3))
+        if command == "quote":
+            added = "!quote user{} {}".format(self.random.randrange(10), words)
+            return self.random.choice(("!quote", "!quote user1", added))
+        if command == "qlist":
+            return self.random.choice(("!qlist", "!qlist user1", "!qlist 2"))
+        if command == "roll":
+            return "!roll {}d{}".format(self.random.randint(1, 10), self.random.choice((6, 20, 100)))
+        if command == "play":
+            return "!play " + words
+        if command == "say":
+            return "!say " + words
+        if command == "clip":
+            return "!" + self.random.choice(CLIPS)
+        return "!" + command
+
+    async def worker(self, deadline, record):
+        while time.monotonic() < deadline:
+            server = self.random.choice(self.servers)
+            command = self.random.choices(self.commands, self.weights)[0]
+            message = FakeMessage(self.random.choice(server.members), self.random.choice(server.channels),
+                                  self.content(command))
+            start = time.perf_counter()
+            try:
+                await self.bot.process_commands(message)
+            except Exception:
+                self.errors += 1
+            if record():
+                self.latencies[command].append(time.perf_counter() - start)
+
+    async def watch_loop(self, deadline, record):
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            if record():
+                self.lags.append(max(0.0, time.perf_counter() - start - 0.01))
+
+    async def run(self, seconds, warmup):
+        start = time.monotonic()
+        deadline = start + warmup + seconds
+
+        def record():
+            return time.monotonic() >= start + warmup
+        await asyncio.gather(self.watch_loop(deadline, record),
+                             *[self.worker(deadline, record) for _ in range(self.concurrency)])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summarise(replay, seconds):
+    result = {'commands': {}, 'errors': replay.errors, 'voice_frames': replay.sink.frames,
+              'messages': replay.sink.messages, 'loop_lag_p50': percentile(replay.lags, 50),
+              'loop_lag_p99': percentile(replay.lags, 99), 'loop_lag_max': max(replay.lags or [0.0])}
+    total = 0
+    for command, latencies in sorted(replay.latencies.items()):
+        total += len(latencies)
+        result['commands'][command] = {'throughput': len(latencies) / seconds, 'p50': percentile(latencies, 50),
+                                       'p95': percentile(latencies, 95), 'p99': percentile(latencies, 99)}
+    result['throughput'] = total / seconds
+    return result
+
+
+def report(result):
+    print("{:<8}{:>12}{:>10}{:>10}{:>10}".format("command", "per second", "p50 ms", "p95 ms", "p99 ms"))
+    for command, stats in result['commands'].items():
+        print("{:<8}{:>12.1f}{:>10.2f}{:>10.2f}{:>10.2f}".format(command, stats['throughput'], stats['p50'] * 1000,
+                                                                 stats['p95'] * 1000, stats['p99'] * 1000))
+    print("{:.1f} commands a second, {} errors, {} messages sent, {} voice frames sent".format(
+        result['throughput'], result['errors'], result['messages'], result['voice_frames']))
+    print("event loop lag p50 {:.2f}ms p99 {:.2f}ms worst {:.2f}ms".format(
+        result['loop_lag_p50'] * 1000, result['loop_lag_p99'] * 1000, result['loop_lag_max'] * 1000))
+
+
+# returns a line for everything worse then baseline by more then tolerance
+def regressions(result, baseline, tolerance):
+    found = []
+    for command, old in baseline.get('commands', {}).items():
+        new = result['commands'].get(command)
+        if new is None:
+            continue
+        if new['p95'] > old['p95'] * (1 + tolerance):
+            found.append("{} p95 {:.2f}ms, was {:.2f}ms".format(command, new['p95'] * 1000, old['p95'] * 1000))
+        if new['throughput'] < old['throughput'] * (1 - tolerance):
+            found.append("{} {:.1f} a second, was {:.1f}".format(command, new['throughput'], old['throughput']))
+    if 'loop_lag_p99' in baseline and result['loop_lag_p99'] > max(baseline['loop_lag_p99'], 0.001) * (1 + tolerance):
+        found.append("event loop lag p99 {:.2f}ms, was {:.2f}ms".format(result['loop_lag_p99'] * 1000,
+                                                                        baseline['loop_lag_p99'] * 1000))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replays traffic through the bot without discord")
+    parser.add_argument("--seconds", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3, help="seconds run before anything is measured")
+    parser.add_argument("--concurrency", type=int, default=20, help="commands being handled at once")
+    parser.add_argument("--servers", type=int, default=10)
+    parser.add_argument("--mix", default=",".join("{}={}".format(*item) for item in DEFAULT_MIX.items()),
+                        help="command=weight pairs, commands are " + ", ".join(DEFAULT_MIX))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--rate-limits", action="store_true", help="keep the outbox's discord rate limits")
+    parser.add_argument("--name", default="default", help="name the baseline is saved under")
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="change from the baseline counted as worse")
+    args = parser.parse_args()
+    mix = {command: float(weight) for command, weight in (pair.split("=") for pair in args.mix.split(","))}
+
+    workspace = make_workspace()
+    os.chdir(workspace)
+    sys.path.insert(0, REPO)
+    try:
+        import Jerry
+        from outbox import Outbox
+        from resolver import TrackResolver
+
+        bot = Jerry.make_bot()
+        cog = bot.get_cog('Music')
+        sink = Sink(bot)
+        bot.connection.user = FakeMember(FakeServer(0), 0)
+        for name in ('send_message', 'edit_message', 'add_reaction', 'remove_reaction', 'wait_for_reaction',
+                     'join_voice_channel'):
+            setattr(bot, name, getattr(sink, name))
+        if not args.rate_limits:
+            bot.outbox = Outbox(bot, rate=10 ** 9, per=1.0, global_rate=10 ** 9, index=bot.message_index)
+
+        async def extract(url):
+            await asyncio.sleep(YTDL_DELAY)
+            return fake_lookup(url), time.time()
+        cog.resolver = TrackResolver(bot.loop, cog.yt_cache)
+        cog.resolver.extract = extract
+        cog.tts_cache.render = lambda text, lang, slow: fake_render(cog.tts_cache, text, lang, slow)
+
+        replay = Replay(bot, cog, sink, mix, args.servers, args.concurrency, args.seed)
+        bot.loop.run_until_complete(replay.run(args.seconds, args.warmup))
+        result = summarise(replay, args.seconds)
+        bot.remove_cog('Music')
+        bot.loop.run_until_complete(asyncio.sleep(0.5))  # lets voice states disconnect
+    finally:
+        os.chdir(REPO)
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    report(result)
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as file:
+            baselines = json.load(file)
+    if args.save_baseline:
+        baselines[args.name] = result
+        with open(args.baselines, 'w') as file:
+            json.dump(baselines, file, indent=2, sort_keys=True)
+        print("Saved baseline {} to {}".format(args.name, args.baselines))
+    elif args.name in baselines:
+        found = regressions(result, baselines[args.name], args.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        if found:
+            sys.exit(1)
+        print("No regressions against baseline {}".format(args.name))
+
+
+if __name__ == '__main__':
+    main()
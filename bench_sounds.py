@@ -0,0 +1,65 @@
+"""
+Measures time to first audio frame for the soundboard clips.
+Compares starting ffmpeg for every play against the opus frame cache,
+both loaded from disk after a restart and already held in memory.
+Run with: python bench_sounds.py [repeats]
+"""
+import asyncio
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import discord
+
+from soundlibrary import SoundLibrary, FRAME_SIZE, SAMPLING_RATE, CHANNELS
+
+CLIPS = [name for name in sorted(os.listdir("sound")) if name.endswith((".ogg", ".mp3")) and name != "say.mp3"]
+VOLUME = 0.04
+
+
+# what play_sound did before: start ffmpeg, wait for a frame of pcm then encode it
+def ffmpeg_first_frame(path, encoder):
+    process = subprocess.Popen(["ffmpeg", "-loglevel", "error", "-i", path, "-f", "s16le", "-ar", str(SAMPLING_RATE),
+                                "-ac", str(CHANNELS), "pipe:1"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    pcm = process.stdout.read(FRAME_SIZE)
+    encoder.encode(pcm, encoder.samples_per_frame)
+    process.kill()
+    process.wait()
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    function(*args)
+    return (time.perf_counter() - start) * 1000
+
+
+def report(name, times):
+    print("{:<24} median {:8.3f}ms  max {:8.3f}ms".format(name, statistics.median(times), max(times)))
+
+
+def main(repeats):
+    if not discord.opus.is_loaded():
+        discord.opus.load_opus('opus')
+    encoder = discord.opus.Encoder(SAMPLING_RATE, CHANNELS)
+    library = SoundLibrary("sound", os.path.join("sound", "frames"), asyncio.get_event_loop())
+    for name in CLIPS:  # make sure every clip is in the frame cache
+        library.load(name, VOLUME)
+
+    before, cold, warm = [], [], []
+    for _ in range(repeats):
+        for name in CLIPS:
+            before.append(timed(ffmpeg_first_frame, os.path.join("sound", name), encoder))
+            cold.append(timed(lambda: library.load(name, VOLUME).frame(0)))
+            clip = library.load(name, VOLUME)
+            warm.append(timed(clip.frame, 0))
+
+    print("time to first audio over {} clips, {} repeats".format(len(CLIPS), repeats))
+    report("ffmpeg per play", before)
+    report("frame cache from disk", cold)
+    report("frame cache in memory", warm)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
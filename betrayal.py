@@ -0,0 +1,112 @@
+from betrayalplayer import ROSTER
+
+PICK_EMOJI = tuple(chr(0x1f1e6 + i) for i in range(len(ROSTER)))  # regional indicator letters, A for the first
+PICKS = {emoji: i for i, emoji in enumerate(PICK_EMOJI)}
+MAX_PLAYERS = max(character.colour for character in ROSTER) + 1  # every player needs a colour of their own
+
+
+class BetrayalSession:
+    """
+    Betrayal at House on the Hill game being set up in one channel. Players take turns picking a
+    character by reacting to the roster message. A character can not be picked once either
+    side of its card has been, the colours taken are kept as bits of taken
+    """
+
+    __slots__ = ('channel', 'players', 'message', 'picks', 'taken', 'timer')
+
+    def __init__(self, channel, players):
+        self.channel = channel
+        self.players = players
+        self.message = None  # roster message picks are made on
+        self.picks = []  # roster index picked by each player so far
+        self.taken = 0
+        self.timer = None  # ends the session if nobody picks for a while
+
+    @property
+    def done(self):
+        return len(self.picks) == self.players
+
+    # Picks the character for the next player. Returns why the pick is not allowed, None if it is
+    def pick(self, index):
+        colour = 1 << ROSTER[index].colour
+        if self.taken & colour:
+            if index in self.picks:
+                return "{} has already been chosen".format(ROSTER[index].name)
+            return "A character with the same colour as {} has already been chosen".format(ROSTER[index].name)
+        self.taken |= colour
+        self.picks.append(index)
+        return None
+
+    def roster(self):
+        lines = []
+        for emoji, character in zip(PICK_EMOJI, ROSTER):
+            line = "{} {}".format(emoji, character.name)
+            if self.taken & (1 << character.colour):
+                line = "~~{}~~".format(line)
+            lines.append(line)
+        if not self.done:
+            lines.append("\nReact with the character for player {}".format(len(self.picks) + 1))
+        return "\n".join(lines)
+
+    def summary(self):
+        return "\n\n".join("Player {}: {}".format(player + 1, ROSTER[index]) for player, index in enumerate(self.picks))
+
+
+class BetrayalSessions:
+    """
+    Games being set up, at most one per channel. Reactions are matched to the game by the id of
+    the message they are on, so any number of games can wait for picks without listening to
+    every message. A game ends if nobody picks for timeout seconds, calling expired with it
+    """
+
+    def __init__(self, loop, expired, timeout=60):
+        self.loop = loop
+        self.expired = expired
+        self.timeout = timeout
+        self.by_channel = {}  # channel id -> session
+        self.by_message = {}  # roster message id -> session
+
+    # returns new session for channel, None if a game is already being set up there
+    def start(self, channel, players):
+        if channel.id in self.by_channel:
+            return None
+        session = self.by_channel[channel.id] = BetrayalSession(channel, players)
+        self.wait(session)
+        return session
+
+    def attach(self, session, message):
+        session.message = message
+        self.by_message[message.id] = session
+
+    def find(self, message_id):
+        return self.by_message.get(message_id)
+
+    # restarts the time the session waits for its next pick
+    def wait(self, session):
+        if session.timer is not None:
+            session.timer.cancel()
+        session.timer = self.loop.call_later(self.timeout, self.expire, session)
+
+    def expire(self, session):
+        session.timer = None
+        if self.end(session):
+            self.expired(session)
+
+    # forgets the session, returns False if it had already ended
+    def end(self, session):
+        if self.by_channel.get(session.channel.id) is not session:
+            return False
+        del self.by_channel[session.channel.id]
+        if session.message is not None:
+            self.by_message.pop(session.message.id, None)
+        if session.timer is not None:
+            session.timer.cancel()
+            session.timer = None
+        return True
+
+    def close(self):
+        for session in list(self.by_channel.values()):
+            self.end(session)
+
+    def __len__(self):
+        return len(self.by_channel)
@@ -4,13 +4,26 @@ class BetrayalPlayer:
     can have in Betrayal at House on Hill
     """
 
-    def __init__(self, name, might, speed, sanity, knowledge):
+    __slots__ = ('name', 'might', 'speed', 'sanity', 'knowledge', 'colour')
+
+    def __init__(self, name, might, speed, sanity, knowledge, colour):
         self.name = name
         self.might = might
         self.speed = speed
         self.sanity = sanity
         self.knowledge = knowledge
+        self.colour = colour  # the two characters on each side of a card share a colour
 
     def __str__(self):
         return ("{}\nMight: {}\nSpeed: {}\nSanity: {}\nKnowledge: {}"
-                .format(self.name, self.might, self.speed, self.sanity, self.knowledge))
\ No newline at end of file
+                .format(self.name, self.might, self.speed, self.sanity, self.knowledge))
+
+
+# Every character, characters next to each other are the two sides of one card and share a colour
+ROSTER = tuple(BetrayalPlayer(*stats, colour=i // 2) for i, stats in enumerate((
+    ("Madame Zostra", 4, 3, 4, 4), ("Vivian Lopez", 2, 4, 4, 5),
+    ("Darrin 'Flash' Williams", 3, 6, 3, 3), ("Ox Bellows", 5, 4, 3, 3),
+    ("Brandon Jaspers", 4, 4, 4, 3), ("Peter Akimoto", 3, 4, 4, 4),
+    ("Heather Granville", 3, 4, 3, 5), ("Jenny LeClerc", 4, 4, 4, 3),
+    ("Zoe Ingstrom", 3, 4, 5, 3), ("Missy Dubourde", 3, 5, 3, 4),
+    ("Professor Longfellow", 3, 4, 3, 5), ("Father Rhinehardt", 2, 3, 6, 4))))
@@ -0,0 +1,185 @@
+import re
+
+import numpy as np
+
+from outbox import MESSAGE_LIMIT
+
+MAX_DICE = 1000000  # dice in one expression, before any explode
+MAX_SIDES = 1000000000
+MAX_TERMS = 20
+MAX_EXPLODES = 100  # rounds of exploding dice rolled again
+SHOW_DICE = 40  # dice rolls written out one by one, any more are summarised
+
+RNG = np.random.default_rng()
+
+TERM = re.compile(r'([+-])?(?:(\d*)d(\d+|%)(?:(kh|kl|k|dh|dl|d)(\d+))?(!)?|(\d+))')
+
+
+class DiceError(ValueError):
+    pass
+
+
+class Dice:
+    """
+    count dice of sides sides. keep is how many of the highest, or lowest if low is set,
+    are added up, None for all of them. Exploding dice are rolled again on their highest side
+    """
+
+    def __init__(self, count, sides, keep=None, low=False, explode=False, sign=1):
+        self.count = count
+        self.sides = sides
+        self.keep = keep
+        self.low = low
+        self.explode = explode
+        self.sign = sign
+
+    def __str__(self):
+        text = "{}d{}".format(self.count, self.sides)
+        if self.keep is not None:
+            text += "{}{}".format("kl" if self.low else "kh", self.keep)
+        return text + ("!" if self.explode else "")
+
+
+class Constant:
+    def __init__(self, value, sign=1):
+        self.value = value
+        self.sign = sign
+
+    def __str__(self):
+        return str(self.value)
+
+
+# Reads a dice expression such as 4d6kh3+2d8+5 into a list of Dice and Constant terms.
+# Drop modifiers are turned into keeps, 4d6dl1 is the same as 4d6kh3
+def parse(text):
+    text = re.sub(r'\s*([+-])\s*', r'\1', text.strip().lower())  # spaces are only allowed around + and -
+    terms = []
+    position = 0
+    while position < len(text):
+        match = TERM.match(text, position)
+        if match is None or match.end() == position or (terms and match.group(1) is None):
+            raise DiceError("Could not read the roll at '{}'".format(text[position:] or text))
+        sign_text, count, sides, modifier, amount, explode, constant = match.groups()
+        sign = -1 if sign_text == '-' else 1
+        if constant is not None:
+            terms.append(Constant(int(constant), sign))
+        else:
+            terms.append(make_dice(int(count or 1), 100 if sides == '%' else int(sides), modifier,
+                                   None if amount is None else int(amount), bool(explode), sign))
+        position = match.end()
+    if not terms:
+        raise DiceError("Nothing to roll")
+    if len(terms) > MAX_TERMS:
+        raise DiceError("Rolls can have at most {} parts".format(MAX_TERMS))
+    if sum(term.count for term in terms if isinstance(term, Dice)) > MAX_DICE:
+        raise DiceError("Rolls can have at most {:,} dice".format(MAX_DICE))
+    return terms
+
+
+def make_dice(count, sides, modifier, amount, explode, sign):
+    if count < 1 or sides < 1:
+        raise DiceError("Dice need at least one die and one side")
+    if sides > MAX_SIDES:
+        raise DiceError("Dice can have at most {:,} sides".format(MAX_SIDES))
+    if explode and sides < 2:
+        raise DiceError("One sided dice can not explode")
+    keep, low = None, False
+    if modifier is not None:
+        if amount > count:
+            raise DiceError("Can not keep or drop {} of {} dice".format(amount, count))
+        if modifier in ('kh', 'k'):
+            keep = amount
+        elif modifier == 'kl':
+            keep, low = amount, True
+        elif modifier in ('dl', 'd'):
+            keep = count - amount
+        else:  # dh
+            keep, low = count - amount, True
+        if keep == 0:
+            raise DiceError("Can not drop every die")
+    return Dice(count, sides, keep, low, explode, sign)
+
+
+# Rolls dice and returns the value of each die, with exploded rolls added to the die they came from
+def roll_dice(dice, rng):
+    rolls = rng.integers(1, dice.sides + 1, size=dice.count, dtype=np.int64)
+    if dice.explode:
+        again = np.flatnonzero(rolls == dice.sides)
+        for _ in range(MAX_EXPLODES):
+            if len(again) == 0:
+                break
+            extra = rng.integers(1, dice.sides + 1, size=len(again), dtype=np.int64)
+            rolls[again] += extra
+            again = again[extra == dice.sides]
+    return rolls
+
+
+# returns bool array of which rolls are kept
+def kept(dice, rolls):
+    if dice.keep is None or dice.keep == len(rolls):
+        return np.ones(len(rolls), dtype=bool)
+    # stable sort so equal rolls are kept left to right
+    order = np.argsort(rolls if dice.low else -rolls, kind='stable')
+    mask = np.zeros(len(rolls), dtype=bool)
+    mask[order[:dice.keep]] = True
+    return mask
+
+
+class RollResult:
+    def __init__(self, terms, parts, total):
+        self.terms = terms
+        self.parts = parts  # for each term, (rolls, kept mask) or the constant
+        self.total = total
+
+    # Writes each die rolled, crossing out dropped dice. Terms with many dice are summarised
+    # instead. If that is too long for a message of limit characters each term is only written
+    # as its sum, and if even that is too long only the total is given
+    def describe(self, limit=MESSAGE_LIMIT):
+        for short in (False, True):
+            text = self.write_terms(short)
+            if len(self.terms) == 1 and isinstance(self.terms[0], Dice) and len(self.parts[0][0]) == 1:
+                if self.terms[0].sign > 0:
+                    return text  # one die is its own total
+            text = "{} = **{:,}**".format(text, self.total)
+            if len(text) <= limit:
+                return text
+        return "**{:,}**".format(self.total)
+
+    def write_terms(self, short):
+        text = ""
+        shown = 0
+        for term, part in zip(self.terms, self.parts):
+            if text:
+                text += " - " if term.sign < 0 else " + "
+            elif term.sign < 0:
+                text = "-"
+            if isinstance(term, Constant):
+                text += str(term.value)
+                continue
+            rolls, mask = part
+            chosen = rolls[mask]
+            if short:
+                text += "{} ({:,})".format(term, int(chosen.sum()))
+            elif shown + len(rolls) <= SHOW_DICE:
+                shown += len(rolls)
+                text += "[{}]".format(", ".join(str(value) if keep else "~~{}~~".format(value)
+                                                for value, keep in zip(rolls.tolist(), mask.tolist())))
+            else:
+                text += "{} (sum {:,}, lowest {:,}, highest {:,}, mean {:.2f})".format(
+                    term, int(chosen.sum()), int(chosen.min()), int(chosen.max()), float(chosen.mean()))
+        return text
+
+
+def roll(terms, rng=RNG):
+    parts = []
+    total = 0
+    for term in terms:
+        if isinstance(term, Constant):
+            parts.append(term.value)
+            total += term.sign * term.value
+        else:
+            rolls = roll_dice(term, rng)
+            mask = kept(term, rolls)
+            parts.append((rolls, mask))
+            total += term.sign * int(rolls[mask].sum())
+    return RollResult(terms, parts, total)
@@ -0,0 +1,110 @@
+import asyncio
+import datetime
+import json
+import random
+import time
+
+from outbox import Outbox
+
+# commands sent to the bot, only ones that need no voice connection and change nothing saved
+COMMANDS = ("!flip", "!roll 2d6", "!fmk", "!fmkd", "!qcheck", "!qsearch the", "!playing", "!skip")
+
+
+class FakeServer:
+    def __init__(self, server_id):
+        self.id = str(server_id)
+        self.name = "Server " + self.id
+        self.channels = [FakeChannel(self, n) for n in range(3)]
+        self.members = [FakeMember(self, n) for n in range(10)]
+
+
+class FakeChannel:
+    def __init__(self, server, n):
+        self.id = "{}{}".format(server.id, n)
+        self.name = "channel-{}".format(n)
+        self.server = server
+        self.is_private = False
+
+
+class FakeMember:
+    def __init__(self, server, n):
+        self.id = "{}{:02}".format(server.id, n)
+        self.name = "user{}".format(n)
+        self.display_name = self.name
+        self.mention = "<@{}>".format(self.id)
+        self.server = server
+        self.voice_channel = None
+        self.server_permissions = FakePermissions()
+        self.bot = False
+
+
+class FakePermissions:
+    administrator = False
+
+
+class FakeMessage:
+    next_id = 1
+
+    def __init__(self, author, channel, content):
+        self.id = str(FakeMessage.next_id)
+        FakeMessage.next_id += 1
+        self.author = author
+        self.channel = channel
+        self.server = channel.server
+        self.content = content
+        self.mentions = []
+        self.timestamp = datetime.datetime.utcnow()
+
+
+class FakeGateway:
+    """
+    Stand-in for the discord gateway used to measure how many commands a shard handles.
+    Makes messages in made up servers, keeps the ones discord would send to this shard
+    and runs them through the bot's command handling. Sending is replaced with a sink
+    that only counts messages, and the outbox is given no rate limit
+    """
+
+    def __init__(self, bot, shard_id, shard_count, servers=1000, concurrency=50):
+        self.bot = bot
+        self.concurrency = concurrency  # messages being handled at once
+        # discord gives a server to shard (server id >> 22) % shard count
+        self.servers = [FakeServer((n + 1) << 22) for n in range(servers) if (n + 1) % shard_count == shard_id]
+        self.handled = 0
+        self.sent = 0
+        self.latencies = []
+
+        bot.connection.user = FakeMember(FakeServer(0), 0)
+        bot.send_message = self.send_message
+        bot.outbox = Outbox(bot, rate=10 ** 9, per=1.0, global_rate=10 ** 9, index=bot.message_index)
+
+    async def send_message(self, channel, content):
+        self.sent += 1
+        return FakeMessage(self.bot.user, channel, content)
+
+    # sends random commands until deadline
+    async def worker(self, deadline):
+        while time.monotonic() < deadline:
+            server = random.choice(self.servers)
+            message = FakeMessage(random.choice(server.members), random.choice(server.channels),
+                                  random.choice(COMMANDS))
+            start = time.monotonic()
+            await self.bot.process_commands(message)
+            self.latencies.append(time.monotonic() - start)
+            self.handled += 1
+
+    # sends commands for seconds then returns what was handled
+    async def drive(self, seconds):
+        start = time.monotonic()
+        await asyncio.gather(*[self.worker(start + seconds) for _ in range(self.concurrency)])
+        elapsed = time.monotonic() - start
+        latencies = sorted(self.latencies) or [0.0]
+        return {'servers': len(self.servers), 'commands': self.handled, 'sent': self.sent, 'seconds': elapsed,
+                'p50': latencies[len(latencies) // 2], 'p99': latencies[len(latencies) * 99 // 100]}
+
+
+# runs bot against the stand-in gateway for seconds and writes the result as a json line
+def run(bot, shard_id, shard_count, seconds):
+    gateway = FakeGateway(bot, shard_id, shard_count)
+    result = bot.loop.run_until_complete(gateway.drive(seconds))
+    result['shard'] = shard_id
+    print(json.dumps(result), flush=True)
@@ -0,0 +1,90 @@
+import time
+from collections import OrderedDict, namedtuple
+
+DISCORD_EPOCH = 1420070400000  # milliseconds, time 0 of discord's snowflake ids
+BULK_DELETE_AGE = 14 * 24 * 60 * 60 - 60 * 60  # discord only bulk deletes messages under 14 days old, an hour spare
+BULK_DELETE_LIMIT = 100  # messages one bulk delete can take
+
+# message the bot can delete knowing only its id and channel
+MessageRef = namedtuple('MessageRef', 'id channel')
+
+
+def snowflake_time(snowflake):
+    return ((int(snowflake) >> 22) + DISCORD_EPOCH) / 1000
+
+
+# smallest id a message sent at timestamp could have
+def time_snowflake(timestamp):
+    return str(max(0, int(timestamp * 1000) - DISCORD_EPOCH) << 22)
+
+
+class MessageIndex:
+    """
+    Ids of the bot's own messages and of ! commands in each channel, oldest first, so
+    cleanup can delete them without reading the channel's history. Each channel keeps
+    at most per_channel ids and only the channels used most recently are kept. Each
+    channel also knows the id from which on every such message is in the index, history
+    before that has to be read to find the rest
+    """
+
+    def __init__(self, per_channel=1000, channels=5000):
+        self.per_channel = per_channel
+        self.max_channels = channels
+        self.channels = OrderedDict()  # channel id -> ChannelIndex, least recently used first
+        self.started = time_snowflake(time.time())
+        self.forgot_channel = False  # True once a channel has been dropped, it may come back with gaps
+
+    def channel(self, channel_id):
+        index = self.channels.get(channel_id)
+        if index is None:
+            # messages from before the bot started, or before a channel was dropped, were not seen
+            complete_from = time_snowflake(time.time()) if self.forgot_channel else self.started
+            index = self.channels[channel_id] = ChannelIndex(complete_from)
+            if len(self.channels) > self.max_channels:
+                self.channels.popitem(last=False)
+                self.forgot_channel = True
+        else:
+            self.channels.move_to_end(channel_id)
+        return index
+
+    def add(self, channel_id, message_id):
+        index = self.channel(channel_id)
+        index.ids[message_id] = None
+        if len(index.ids) > self.per_channel:
+            index.ids.popitem(last=False)
+            kept = next(iter(index.ids))  # everything from the oldest id still kept on is indexed
+            if index.complete_from is None or int(kept) > int(index.complete_from):
+                index.complete_from = kept
+
+    def discard(self, channel_id, message_id):
+        index = self.channels.get(channel_id)
+        if index is not None:
+            index.ids.pop(message_id, None)
+
+    # ids indexed in channel, newest first
+    def messages(self, channel_id):
+        index = self.channels.get(channel_id)
+        return list(reversed(index.ids)) if index is not None else []
+
+    # id before which messages may be missing from the index, None if none are
+    def missing_before(self, channel_id):
+        return self.channel(channel_id).complete_from
+
+    # history before the index has been read for channel, nothing is missing any more
+    def filled(self, channel_id):
+        self.channel(channel_id).complete_from = None
+
+    # history has been read for channel back to message_id, only messages before it may be missing
+    def read_back_to(self, channel_id, message_id):
+        index = self.channel(channel_id)
+        if index.complete_from is not None and int(message_id) < int(index.complete_from):
+            index.complete_from = message_id
+
+    def __len__(self):
+        return sum(len(index.ids) for index in self.channels.values())
+
+
+class ChannelIndex:
+    def __init__(self, complete_from):
+        self.ids = OrderedDict()  # message id -> None, used as an ordered set
+        self.complete_from = complete_from
@@ -0,0 +1,178 @@
+import asyncio
+import bisect
+import math
+import sys
+from collections import defaultdict
+
+# seconds, from a fast command reply up to a slow youtube-dl lookup or transcode
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 120.0)
+
+
+class Registry:
+    """
+    Holds every metric and writes them out in the prometheus text format.
+    Recording a value is only a dict lookup and an add, anything that is already
+    counted elsewhere is read through a function only when metrics are asked for
+    """
+
+    def __init__(self):
+        self.metrics = {}  # name -> metric, in the order made
+
+    def add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError("Metric {} already exists".format(metric.name))
+        self.metrics[metric.name] = metric
+        return metric
+
+    def remove(self, name):
+        self.metrics.pop(name, None)
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            try:
+                lines.extend(metric.samples())
+            except Exception as e:  # one broken gauge should not hide everything else
+                print("Could not read metric {}: {}".format(metric.name, e), file=sys.stderr)
+        return "\n".join(lines) + "\n"
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = defaultdict(float)  # label values -> count
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] += amount
+
+    def samples(self):
+        for label_values, value in sorted(self.values.items()):
+            yield "{}{} {}".format(self.name, format_labels(self.labels, label_values), format_value(value))
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}  # label values -> [count in each bucket then over the last, sum]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    # Returns (count, sum, estimated value at each quantile) for the label values,
+    # quantiles are the upper bound of the bucket they fall in
+    def summary(self, label_values, *quantiles):
+        series = self.series.get(label_values)
+        if series is None:
+            return 0, 0.0, [0.0 for _ in quantiles]
+        counts, total = series
+        count = sum(counts)
+        estimates = []
+        for quantile in quantiles:
+            seen = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                seen += bucket_count
+                if seen >= quantile * count:
+                    estimates.append(bound)
+                    break
+        return count, total, estimates
+
+    def samples(self):
+        for label_values, (counts, total) in sorted(self.series.items()):
+            seen = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                seen += bucket_count
+                labels = format_labels(self.labels + ("le",), label_values + (format_value(bound),))
+                yield "{}_bucket{} {}".format(self.name, labels, seen)
+            labels = format_labels(self.labels, label_values)
+            yield "{}_sum{} {}".format(self.name, labels, format_value(total))
+            yield "{}_count{} {}".format(self.name, labels, seen)
+
+
+class Gauge:
+    """
+    Value read from function each time metrics are asked for. With labels the function
+    returns a dict of label values to value, otherwise just the value. Use type="counter"
+    for totals that are already counted elsewhere
+    """
+
+    def __init__(self, name, help, function, labels=(), type="gauge"):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.labels = labels
+        self.type = type
+
+    def samples(self):
+        values = self.function()
+        if not self.labels:
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            yield "{}{} {}".format(self.name, format_labels(self.labels, label_values), format_value(value))
+
+
+def format_labels(labels, label_values):
+    if not labels:
+        return ""
+    pairs = ('{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for label, value in zip(labels, label_values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+registry = Registry()  # metrics from every module end up here
+
+
+def counter(name, help, labels=()):
+    return registry.add(Counter(name, help, labels))
+
+
+def histogram(name, help, labels=(), buckets=DEFAULT_BUCKETS):
+    return registry.add(Histogram(name, help, labels, buckets))
+
+
+def gauge(name, help, function, labels=(), type="gauge"):
+    return registry.add(Gauge(name, help, function, labels, type))
+
+
+# Serves the registry over http on host and port for prometheus to scrape. Only
+# answers GET /metrics, so it should be bound to localhost. Returns the asyncio server
+async def serve(registry, host, port):
+    async def handle(reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass  # headers are not needed
+            parts = request.split()
+            if len(parts) >= 2 and parts[0] == b"GET" and parts[1].split(b"?")[0] == b"/metrics":
+                status, body = "200 OK", registry.render().encode('utf-8')
+            else:
+                status, body = "404 Not Found", b"Metrics are at /metrics\n"
+            writer.write("HTTP/1.0 {}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                         "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode('ascii'))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
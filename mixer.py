@@ -0,0 +1,326 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from soundlibrary import FRAME_LENGTH, FRAME_SIZE
+
+SAMPLES = FRAME_SIZE // 2  # 16 bit samples in a frame, both channels
+DELAY = FRAME_LENGTH / 1000
+
+
+class Mixer(threading.Thread):
+    """
+    Plays every sound for one server through a single voice connection.
+    Each 20ms it takes a frame from every track, adds them together and sends
+    the result, turning music down while clips or tts are playing over it
+    """
+
+    def __init__(self, voice, duck=0.35):
+        threading.Thread.__init__(self, daemon=True)
+        self.voice = voice
+        self.duck = duck  # gain music is turned down to while other tracks play
+        self.music_gain = 1.0
+        self.tracks = []
+        self.lock = threading.Lock()  # tracks are added from the event loop thread
+        self.wake = threading.Event()
+        self._end = threading.Event()
+        self.frames_sent = 0
+        self.late_frames = 0  # frames that took longer then their 20ms to mix
+        self.worst_mix = 0.0
+
+    # track for a discord player that has not been started, music tracks are ducked
+    def stream(self, player, music=False, volume=None):
+        return StreamTrack(self, player, music, player.volume if volume is None else volume)
+
+    # track for a Clip from the sound library, after is called when it ends
+    def clip(self, clip, after=None):
+        return ClipTrack(self, clip, after)
+
+    # track playing pcm handed to it a piece at a time
+    def pcm(self, volume=1.0):
+        return PcmTrack(self, volume)
+
+    def add(self, track):
+        with self.lock:
+            self.tracks.append(track)
+        self.wake.set()
+
+    def remove(self, track):
+        with self.lock:
+            if track in self.tracks:
+                self.tracks.remove(track)
+        track.finish()
+
+    def is_playing(self):
+        return any(not track.done for track in self.tracks)
+
+    # stops every track and ends the thread
+    def stop(self):
+        self._end.set()
+        self.wake.set()
+        with self.lock:
+            tracks, self.tracks = self.tracks, []
+        for track in tracks:
+            track.done = True
+            track.finish()
+
+    def run(self):
+        loops = 0
+        start = None
+        while not self._end.is_set():
+            with self.lock:
+                tracks = list(self.tracks)
+            if not tracks:  # nothing to play, sleep until a track is added
+                self.wake.wait()
+                self.wake.clear()
+                start = None
+                continue
+            if start is None:
+                start = time.perf_counter()
+                loops = 0
+
+            began = time.perf_counter()
+            frames = []
+            for track in tracks:
+                frame = None if track.done or track.paused else track.read()
+                if track.done:
+                    self.remove(track)
+                elif frame is not None:
+                    frames.append((track, frame))
+            if frames and self.voice._connected.is_set():
+                self.send(frames)
+
+            took = time.perf_counter() - began
+            self.worst_mix = max(self.worst_mix, took)
+            if took > DELAY:
+                self.late_frames += 1
+            loops += 1
+            time.sleep(max(0, start + DELAY * loops - time.perf_counter()))
+
+    def send(self, frames):
+        self.frames_sent += 1
+        target = self.duck if any(not track.music for track, _ in frames) else 1.0
+        if len(frames) == 1:
+            opus = frames[0][0].opus()
+            if opus is not None:  # clip played on its own is already encoded
+                self.music_gain = target
+                self.voice.play_audio(opus, encode=False)
+                return
+        music = [(track.volume, frame) for track, frame in frames if track.music]
+        others = [(track.volume, frame) for track, frame in frames if not track.music]
+        data = mix_frames(music, others, self.music_gain, target)
+        self.music_gain = target
+        self.voice.play_audio(data)
+
+
+# Adds frames of 16 bit pcm together and returns them as one frame.
+# Music frames are faded from gain to target over the frame so ducking does not click
+def mix_frames(music, others, gain, target):
+    out = np.zeros(SAMPLES, dtype=np.float32)
+    if music:
+        volumes = np.array([volume for volume, _ in music], dtype=np.float32)
+        music = np.dot(volumes, np.stack([np.frombuffer(frame, dtype=np.int16) for _, frame in music]))
+        if gain == target:
+            out += music * target
+        else:
+            out += music * np.repeat(np.linspace(gain, target, SAMPLES // 2, dtype=np.float32), 2)
+    if others:
+        volumes = np.array([volume for volume, _ in others], dtype=np.float32)
+        out += np.dot(volumes, np.stack([np.frombuffer(frame, dtype=np.int16) for _, frame in others]))
+    np.clip(out, -32768, 32767, out=out)
+    return out.astype(np.int16).tobytes()
+
+
+class Track:
+    """
+    Something playing through a Mixer. Has the same methods as a discord player
+    so it can be used in place of one
+    """
+
+    music = False
+
+    def __init__(self, mixer, volume=1.0, after=None):
+        self.mixer = mixer
+        self._volume = volume
+        self.after = after
+        self.started = False
+        self.paused = False
+        self.done = False
+        self.finished = threading.Event()
+
+    @property
+    def volume(self):
+        return self._volume
+
+    @volume.setter
+    def volume(self, value):
+        self._volume = max(value, 0.0)
+
+    def start(self):
+        self.started = True
+        self.mixer.add(self)
+
+    def stop(self):
+        self.done = True
+        if not self.started:
+            self.finish()
+        else:
+            self.mixer.wake.set()
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+    def is_playing(self):
+        return self.started and not self.paused and not self.done
+
+    def is_done(self):
+        return self.finished.is_set()
+
+    # next frame of pcm, None if there is nothing this frame. Sets done when out of audio
+    def read(self):
+        raise NotImplementedError
+
+    # opus encoded version of the last frame read, None if there is not one
+    def opus(self):
+        return None
+
+    # called once when track is done, frees anything held and calls after
+    def finish(self):
+        if self.finished.is_set():
+            return
+        self.finished.set()
+        if self.after is not None:
+            self.after()
+
+
+class ClipTrack(Track):
+    """
+    Track playing a Clip from the sound library, frames come straight from memory
+    """
+
+    def __init__(self, mixer, clip, after=None):
+        super().__init__(mixer, 1.0, after)
+        self.clip = clip
+        self.position = -1
+
+    @property
+    def duration(self):
+        return self.clip.duration
+
+    def read(self):
+        self.position += 1
+        if self.position >= len(self.clip):
+            self.done = True
+            return None
+        return self.clip.pcm(self.position)
+
+    def opus(self):
+        if self._volume != 1.0:
+            return None
+        return self.clip.frame(self.position)
+
+
+class StreamTrack(Track):
+    """
+    Track reading pcm from a discord player that is never started itself, such
+    as the ffmpeg player made by create_ytdl_player. A thread reads ahead from ffmpeg
+    so a slow stream only makes this track go quiet instead of holding up the mixer
+    """
+
+    def __init__(self, mixer, player, music, volume, buffered=50):
+        super().__init__(mixer, volume, player._call_after)
+        self.player = player
+        self.music = music
+        self.buffer = queue.Queue(maxsize=buffered)
+        self.reader = threading.Thread(target=self.read_ahead, daemon=True)
+        self.ended = False  # reader has got to the end of the stream
+
+    # anything not on the track such as title and duration comes from the player
+    def __getattr__(self, name):
+        if name == 'player':
+            raise AttributeError(name)
+        return getattr(self.player, name)
+
+    @Track.volume.setter
+    def volume(self, value):
+        self._volume = min(max(value, 0.0), 2.0)
+
+    def start(self):
+        self.reader.start()
+        super().start()
+
+    def read_ahead(self):
+        try:
+            while not self.done:
+                data = self.player.buff.read(FRAME_SIZE)
+                if len(data) != FRAME_SIZE:
+                    break
+                while not self.done:
+                    try:
+                        self.buffer.put(data, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            self.player._current_error = e
+        finally:
+            self.ended = True
+
+    def read(self):
+        try:
+            return self.buffer.get_nowait()
+        except queue.Empty:
+            if self.ended:
+                self.done = True
+            return None
+
+    def finish(self):
+        process = getattr(self.player, 'process', None)
+        if process is not None:
+            process.kill()
+            if process.poll() is None:
+                process.communicate()
+        super().finish()
+
+
+class PcmTrack(Track):
+    """
+    Track playing pcm fed to it in pieces while it plays, such as tts made a sentence at a
+    time. A frame that has not been fed by its turn is silence. The track ends once end has
+    been called and everything fed before it has played
+    """
+
+    END = None  # put after the last frame
+
+    def __init__(self, mixer, volume=1.0, after=None):
+        super().__init__(mixer, volume, after)
+        self.frames = queue.Queue()
+
+    # adds pcm to the end of the track, padding the last frame with silence
+    def feed(self, pcm):
+        if len(pcm) % FRAME_SIZE:
+            pcm += bytes(FRAME_SIZE - len(pcm) % FRAME_SIZE)
+        for i in range(0, len(pcm), FRAME_SIZE):
+            self.frames.put(pcm[i:i + FRAME_SIZE])
+
+    # nothing more will be fed
+    def end(self):
+        self.frames.put(self.END)
+
+    # frames fed that have not been played yet
+    def buffered(self):
+        return self.frames.qsize()
+
+    def read(self):
+        try:
+            frame = self.frames.get_nowait()
+        except queue.Empty:  # next piece is not ready yet
+            return None
+        if frame is self.END:
+            self.done = True
+        return frame
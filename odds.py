@@ -0,0 +1,300 @@
+import functools
+import math
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from dice import Constant, DiceError, parse
+
+MAX_OUTCOMES = 2000000  # totals a distribution can have
+MAX_KEEP_DICE = 1000000  # kept dice times dice, the ways of placing dice worked out for each side
+MAX_KEEP_STEPS = 20000000  # sides times kept dice times dice
+MAX_KEEP_WORK = 250000000  # sides times kept dice times the totals each adds up, about half a second
+DIRECT_KEEP_WORK = 50000000  # keeping dice adds up totals without an fft below this much work
+MEMO_BYTES = 64 * 1024 * 1024  # distributions memoised, most recently used kept
+EXPLODE_CUTOFF = 1e-12  # exploding dice are followed until they are less likely then this
+FFT_OVER = 5000  # distributions longer then this are convolved with an fft
+
+# P(10d6 >= 35), 10d6>=35 or 4d6kh3 < 10
+QUERY = re.compile(r'^p?\(?(.+?)(>=|<=|==|=|>|<)(-?\d+)\)?$')
+
+
+class Distribution:
+    """
+    Exact chance of every total of a roll. pmf[i] is the chance of rolling offset + i
+    """
+
+    def __init__(self, offset, pmf):
+        self.offset = offset
+        self.pmf = pmf
+        pmf.flags.writeable = False  # shared through the memo
+
+    @property
+    def lowest(self):
+        return self.offset
+
+    @property
+    def highest(self):
+        return self.offset + len(self.pmf) - 1
+
+    def mean(self):
+        return float(np.dot(self.pmf, np.arange(len(self.pmf)))) + self.offset
+
+    def deviation(self):
+        values = np.arange(len(self.pmf)) + self.offset - self.mean()
+        return math.sqrt(max(0.0, float(np.dot(self.pmf, values * values))))
+
+    # most likely total
+    def mode(self):
+        return self.offset + int(np.argmax(self.pmf))
+
+    # chance the total compares to value with op, one of < <= = == >= >
+    def chance(self, op, value):
+        if op in ('=', '=='):
+            i = value - self.offset
+            return float(self.pmf[i]) if 0 <= i < len(self.pmf) else 0.0
+        if op in ('<', '<='):
+            high = value - 1 if op == '<' else value  # highest total counted
+            if high < self.lowest:
+                return 0.0
+            if high >= self.highest:
+                return 1.0
+            return min(1.0, float(self.pmf[:high - self.offset + 1].sum()))
+        low = value + 1 if op == '>' else value  # lowest total counted
+        if low > self.highest:
+            return 0.0
+        if low <= self.lowest:
+            return 1.0
+        return min(1.0, float(self.pmf[low - self.offset:].sum()))
+
+
+class Memo:
+    """
+    Memoises functions returning distributions, forgetting the least recently used once the
+    distributions kept add up to more then max_bytes. Shared by every function it wraps,
+    keyed by the function and its arguments. Used from worker threads
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # (function name, args) -> Distribution, least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, function):
+        @functools.wraps(function)
+        def memoised(*args):
+            key = (function.__name__, args)
+            with self.lock:
+                result = self.entries.get(key)
+                if result is not None:
+                    self.entries.move_to_end(key)
+                    return result
+            result = function(*args)  # worked out without the lock, two threads may both do it
+            with self.lock:
+                if key not in self.entries:
+                    self.entries[key] = result
+                    self.size += result.pmf.nbytes
+                while self.size > self.max_bytes and len(self.entries) > 1:
+                    _, dropped = self.entries.popitem(last=False)
+                    self.size -= dropped.pmf.nbytes
+            return result
+        return memoised
+
+
+memo = Memo(MEMO_BYTES)
+
+
+# smallest length of at least n an fft is quick for, one with no prime factors over 5
+def fft_size(n):
+    best = 1 << max(0, (n - 1).bit_length())
+    fives = 1
+    while fives < best:
+        threes = fives
+        while threes < best:
+            size = threes << max(0, (-(-n // threes) - 1).bit_length())  # times the power of two reaching n
+            best = min(best, size)
+            threes *= 3
+        fives *= 5
+    return best
+
+
+def convolve(a, b):
+    if min(len(a), len(b)) < 64 or len(a) + len(b) < FFT_OVER:
+        return np.convolve(a, b)
+    size = len(a) + len(b) - 1
+    n = fft_size(size)
+    result = np.fft.irfft(np.fft.rfft(a, n) * np.fft.rfft(b, n), n)[:size]
+    return np.clip(result, 0.0, None)  # fft leaves tiny negative values where the chance is 0
+
+
+def add(first, second):
+    if len(first.pmf) + len(second.pmf) - 1 > MAX_OUTCOMES:
+        raise DiceError("That roll has too many possible totals to work out")
+    return Distribution(first.offset + second.offset, convolve(first.pmf, second.pmf))
+
+
+def negate(distribution):
+    return Distribution(-distribution.highest, distribution.pmf[::-1].copy())
+
+
+# distribution of one die, exploding dice are followed until the chance of another explode is tiny
+@memo
+def die(sides, explode):
+    if not explode:
+        if sides > MAX_OUTCOMES:
+            raise DiceError("Dice with that many sides have too many totals to work out")
+        return Distribution(1, np.full(sides, 1.0 / sides))
+    explodes = max(1, math.ceil(-math.log(EXPLODE_CUTOFF) / math.log(sides)))
+    if sides * (explodes + 1) > MAX_OUTCOMES:
+        raise DiceError("Dice with that many sides have too many totals to work out")
+    pmf = np.zeros(sides * (explodes + 1))
+    for n in range(explodes + 1):
+        pmf[n * sides:n * sides + sides - 1] = sides ** -(n + 1.0)
+    pmf[explodes * sides + sides - 1] = sides ** -(explodes + 1.0)  # everything after the last explode followed
+    return Distribution(1, pmf)
+
+
+# Distribution of the total of count dice. Small ones are split in halves that are memoised
+# themselves, so 10d6 and 12d6 share the work for 5d6 and 6d6. Large ones raise the fft of one
+# die to the power of count, so they take one fft there and one back
+@memo
+def dice_sum(count, sides, explode):
+    single = die(sides, explode)
+    if count == 1:
+        return single
+    width = count * (len(single.pmf) - 1) + 1
+    if width > MAX_OUTCOMES:
+        raise DiceError("That roll has too many possible totals to work out")
+    if width < FFT_OVER:
+        return add(dice_sum(count // 2, sides, explode), dice_sum(count - count // 2, sides, explode))
+    n = fft_size(width)
+    pmf = np.fft.irfft(np.fft.rfft(single.pmf, n) ** count, n)[:width]
+    return Distribution(count * single.offset, np.clip(pmf, 0.0, None))
+
+
+# Distribution of the total of the highest keep of count dice, or lowest if low is set.
+# Goes through each side the keep-th best die could have. The a dice better then it, fewer
+# then keep, are all kept along with keep - a dice of that side. The chance of each a comes
+# from how the dice can be placed, and the totals of the a better dice are added up for every
+# a at once as a polynomial in the distribution of one better die, with an fft if it is large
+@memo
+def dice_keep(count, sides, keep, low, explode):
+    single = die(sides, explode)
+    chances = single.pmf[::-1] if low else single.pmf  # lowest kept is highest of sides counted backwards
+    last = len(chances) - 1
+    width = keep * last + 1  # totals counted in sides above the lowest
+    if width > MAX_OUTCOMES:
+        raise DiceError("That roll has too many possible totals to work out")
+    steps = len(chances) * keep * count
+    if keep * count > MAX_KEEP_DICE or steps > MAX_KEEP_STEPS or len(chances) * keep * width > MAX_KEEP_WORK:
+        raise DiceError("Keeping that many dice is too much to work out")
+    direct = width < FFT_OVER and keep * keep * len(chances) ** 3 // 6 < DIRECT_KEEP_WORK
+    if direct:
+        pmf = np.zeros(width)
+    else:
+        n = fft_size(width)
+        frequencies = np.arange(n // 2 + 1)
+        roots = np.exp(-2j * np.pi * np.arange(n) / n)
+        pmf = np.zeros(n // 2 + 1, dtype=complex)
+        better_sides = np.zeros(n // 2 + 1, dtype=complex)  # fft of the chances of the sides above side
+
+    # fft of a single total of m, multiplying by it moves totals up m
+    def shift(m):
+        return roots[frequencies * m % n]
+
+    log_factorial = np.concatenate(([0.0], np.cumsum(np.log(np.arange(1, count + 1)))))
+    better = np.arange(keep)  # a, dice better then the keep-th best
+    same = np.arange(count + 1)[None, :]  # dice with its side
+    worse = count - better[:, None] - same
+    possible = (same >= keep - better[:, None]) & (worse >= 0)
+    ways_better = log_factorial[count] - log_factorial[better] - log_factorial[count - better]
+    ways_rest = log_factorial[count - better[:, None]] - log_factorial[same] - log_factorial[np.clip(worse, 0, None)]
+    above = np.concatenate((np.cumsum(chances[::-1])[::-1][1:], [0.0]))  # chance of a side better then each
+    below = np.concatenate(([0.0], np.cumsum(chances)[:-1]))  # chance of a side worse then each
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for side in range(last, -1, -1):
+            chance = float(chances[side])
+            if side < last and not direct:
+                better_sides += float(chances[side + 1]) * shift(side + 1)
+            if chance == 0:
+                continue
+            # chance of a dice being better then side and it being the keep-th best, added up in logs
+            # as the chances of hundreds of dice are too small for a float
+            logs = ways_rest + same * math.log(chance) + np.where(worse > 0, worse * np.log(below[side]), 0.0)
+            logs = np.where(possible, logs, -np.inf)
+            logs = ways_better + log_sum(logs) + np.where(better > 0, better * np.log(above[side]), 0.0)
+            weights = np.nan_to_num(np.exp(logs))
+            used = np.nonzero(weights)[0]
+            if len(used) == 0:
+                continue
+            most = int(used[-1])
+            if direct:
+                step = np.zeros(last - side + 1)  # a better die, counted in sides above side
+                if most > 0:
+                    step[1:] = chances[side + 1:] / above[side]
+                total = np.array([weights[most]])
+                for a in range(most - 1, -1, -1):
+                    total = np.convolve(total, step)
+                    total[0] += weights[a]
+                pmf[keep * side:keep * side + len(total)] += total
+            else:
+                step = better_sides * shift(n - side) / above[side] if most > 0 else 0
+                total = np.full(n // 2 + 1, weights[most], dtype=complex)
+                for a in range(most - 1, -1, -1):
+                    total *= step
+                    total += weights[a]
+                pmf += total * shift(keep * side)
+    if not direct:
+        pmf = np.fft.irfft(pmf, n)[:width]
+    pmf = np.clip(pmf, 0.0, None)
+    return Distribution(keep * single.offset, pmf[::-1].copy() if low else pmf)
+
+
+# log of the sum of the exps of each row of logs, without the exps going to 0
+def log_sum(logs):
+    top = logs.max(axis=1)
+    top = np.where(np.isfinite(top), top, 0.0)
+    return top + np.log(np.exp(logs - top[:, None]).sum(axis=1))
+
+
+def term_distribution(term):
+    if isinstance(term, Constant):
+        distribution = Distribution(term.value, np.ones(1))
+    elif term.keep is None or term.keep == term.count:
+        distribution = dice_sum(term.count, term.sides, term.explode)
+    else:
+        distribution = dice_keep(term.count, term.sides, term.keep, term.low, term.explode)
+    return distribution if term.sign > 0 else negate(distribution)
+
+
+# exact distribution of the total of a dice expression, memoised on the expression
+@memo
+def distribution(expression):
+    terms = parse(expression)
+    result = term_distribution(terms[0])
+    for term in terms[1:]:
+        result = add(result, term_distribution(term))
+    return result
+
+
+def percent(chance):
+    if chance == 0 or chance >= 0.0001:
+        return "{:.2%}".format(chance)
+    return "{:.3g}%".format(chance * 100)
+
+
+# Answers a question such as P(10d6 >= 35), or describes the roll if there is no comparison
+def answer(question):
+    question = "".join(question.split()).lower()
+    match = QUERY.match(question)
+    expression = match.group(1) if match else question.strip("p()")
+    result = distribution(expression)
+    text = "{}: mean {:.2f}, deviation {:.2f}, {} to {}, most likely {}".format(
+        expression, result.mean(), result.deviation(), result.lowest, result.highest, result.mode())
+    if match:
+        op, value = match.group(2), int(match.group(3))
+        text = "P({} {} {}) = **{}**\n".format(expression, op, value, percent(result.chance(op, value))) + text
+    return text
@@ -0,0 +1,163 @@
+import asyncio
+import sys
+import time
+from collections import deque
+
+REPLY = 0  # answer to a command
+CHATTER = 1  # message nobody asked for, dropped first when channels back up
+
+MESSAGE_LIMIT = 2000
+
+
+class TokenBucket:
+    """
+    Allows rate actions every per seconds, refilling one token at a time
+    """
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+
+    # seconds until a token is free, 0 if one is free now
+    def wait_time(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) * self.per / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Outbox:
+    """
+    Sends every message the bot writes. Each channel has its own queue sent no faster then
+    discord allows for a channel, and short messages waiting for the same channel are
+    joined into one. When a channel backs up chatter is dropped before replies.
+    Messages sent are added to index if one is given
+    """
+
+    def __init__(self, bot, rate=5, per=5.0, global_rate=50, global_per=1.0, max_queued=20, join_under=400,
+                 index=None):
+        self.bot = bot
+        self.index = index
+        self.rate = rate
+        self.per = per
+        self.global_bucket = TokenBucket(global_rate, global_per)
+        self.max_queued = max_queued  # per channel
+        self.join_under = join_under  # messages shorter then this are joined with the next
+        self.channels = {}  # channel id -> ChannelQueue, kept so each channel's rate limit carries over
+        self.sent = 0
+        self.dropped = 0
+        self.latencies = deque(maxlen=1000)  # seconds from send being asked for until sent
+
+    # Queues content to be sent to channel. Returns future of the message sent,
+    # which is None if the message was dropped. join=False sends content in a message of its own
+    def send(self, channel, content, priority=REPLY, join=True):
+        future = asyncio.Future()
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            queue = self.channels[channel.id] = ChannelQueue(channel, TokenBucket(self.rate, self.per))
+        if len(queue.pending) >= self.max_queued and not self.make_room(queue, priority):
+            self.dropped += 1
+            future.set_result(None)
+            return future
+        queue.pending.append(Pending(content, priority, join, future))
+        if queue.task is None:
+            queue.task = asyncio.ensure_future(self.run(queue))
+        return future
+
+    # replies to channel message was sent in
+    def say(self, ctx, content, priority=REPLY, join=True):
+        return self.send(ctx.message.channel, content, priority, join)
+
+    # drops oldest chatter in queue, or oldest reply if the new message is a reply
+    def make_room(self, queue, priority):
+        for pending in queue.pending:
+            if pending.priority == CHATTER:
+                break
+        else:
+            if priority == CHATTER:
+                return False
+            pending = queue.pending[0]
+        queue.pending.remove(pending)
+        if not pending.future.done():
+            pending.future.set_result(None)
+        self.dropped += 1
+        return True
+
+    def depth(self):
+        return sum(len(queue.pending) for queue in self.channels.values())
+
+    # returns send latency in seconds at each percentile given
+    def latency_percentiles(self, *percentiles):
+        latencies = sorted(self.latencies)
+        if not latencies:
+            return [0.0 for _ in percentiles]
+        return [latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] for p in percentiles]
+
+    # sends everything queued for channel then stops
+    async def run(self, queue):
+        try:
+            while queue.pending:
+                wait = max(queue.bucket.wait_time(), self.global_bucket.wait_time())
+                if wait:
+                    await asyncio.sleep(wait)
+                    continue
+                queue.bucket.take()
+                self.global_bucket.take()
+                batch = self.next_batch(queue)
+                content = "\n".join(pending.content for pending in batch)
+                try:
+                    message = await self.bot.send_message(queue.channel, content)
+                except Exception as e:
+                    print("Could not send message to {}: {}".format(queue.channel.id, e), file=sys.stderr)
+                    for pending in batch:
+                        if not pending.future.done():
+                            pending.future.set_exception(e)
+                            pending.future.exception()  # stops asyncio warning about messages nobody waited on
+                    continue
+                now = time.monotonic()
+                self.sent += 1
+                if self.index is not None and message is not None:
+                    self.index.add(queue.channel.id, message.id)
+                for pending in batch:
+                    self.latencies.append(now - pending.queued)
+                    if not pending.future.done():  # caller may have been cancelled
+                        pending.future.set_result(message)
+        finally:
+            queue.task = None
+
+    # takes first message and any short ones queued after it that fit in one message
+    def next_batch(self, queue):
+        batch = [queue.pending.popleft()]
+        length = len(batch[0].content)
+        while queue.pending and batch[0].join and length < self.join_under:
+            pending = queue.pending[0]
+            if not pending.join or len(pending.content) >= self.join_under or \
+                    length + 1 + len(pending.content) > MESSAGE_LIMIT:
+                break
+            batch.append(queue.pending.popleft())
+            length += 1 + len(pending.content)
+        return batch
+
+
+class ChannelQueue:
+    def __init__(self, channel, bucket):
+        self.channel = channel
+        self.bucket = bucket
+        self.pending = deque()
+        self.task = None
+
+
+class Pending:
+    def __init__(self, content, priority, join, future):
+        self.content = content
+        self.priority = priority
+        self.join = join
+        self.future = future
+        self.queued = time.monotonic()
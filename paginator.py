@@ -0,0 +1,71 @@
+class QuotePages:
+    """
+    Splits quotes, of one user or everyone, into pages that fit in a message.
+    Pages only ever end at the end of a line and are worked out as they are asked for,
+    so showing a page does not go through every quote. Where each page starts is kept
+    until the quotes change
+    """
+
+    def __init__(self, store, user=None, limit=1900):
+        self.store = store
+        self.user = user
+        self.limit = limit  # room is left under the 2000 character limit for the page number
+        self.version = None
+        self.starts = []  # (user index, line index) each page found so far starts at
+        self.ended = False  # True once the page after the last one found is known to be empty
+
+    def users(self):
+        if self.user is not None:
+            return [self.user.lower()]
+        return self.store.users()
+
+    # returns text of page n, counting from 0, or None if there are not that many pages
+    def page(self, n):
+        self.store.sync()  # quotes added by other shards
+        if self.version != self.store.version:  # quotes changed, pages found are out of date
+            self.version = self.store.version
+            self.starts = [(0, 0)]
+            self.ended = False
+        while len(self.starts) <= n + 1 and not self.ended:
+            _, next_start = self.render(self.starts[-1])
+            if next_start is None:
+                self.ended = True
+            else:
+                self.starts.append(next_start)
+        if n < 0 or n >= len(self.starts):
+            return None
+        text, _ = self.render(self.starts[n])
+        return text or None  # no quotes at all
+
+    # True if there is a page after page n
+    def has_next(self, n):
+        self.page(n)
+        return n + 1 < len(self.starts)
+
+    # Returns text of page starting at position and where the next page starts.
+    # Line 0 of each user is their name, line i is their quote i - 1
+    def render(self, position):
+        users = self.users()
+        user, line = position
+        lines = []
+        length = 0
+        while user < len(users):
+            user_quotes = self.store.quote_list(users[user])
+            if line > len(user_quotes) or not user_quotes:  # on to next user
+                user += 1
+                line = 0
+                continue
+            if line == 0:
+                text = "{}:".format(users[user].capitalize())
+                if lines:  # blank line between users
+                    text = "\n" + text
+            else:
+                text = user_quotes[line - 1]
+            if length + len(text) + 1 > self.limit:
+                if lines:
+                    return "\n".join(lines), (user, line)
+                text = text[:self.limit]  # quote longer then a page on its own is cut short
+            lines.append(text)
+            length += len(text) + 1
+            line += 1
+        return "\n".join(lines), None
@@ -0,0 +1,129 @@
+import bisect
+import re
+from collections import defaultdict
+
+WORD = re.compile(r"\w+")
+
+
+class QuoteIndex:
+    """
+    Inverted index of every word in the quotes, and the names of who said them.
+    Kept up to date as quotes are added and removed instead of being rebuilt.
+    Words can be matched exactly, by their start or with one letter wrong
+    """
+
+    def __init__(self, store, max_expand=50):
+        self.max_expand = max_expand  # most words a prefix or typo can match
+        self.postings = defaultdict(set)  # word -> (user, quote) of each quote with it
+        self.counts = defaultdict(int)  # (user, quote) -> times that quote is stored
+        self.words = []  # every word indexed, sorted for prefix search
+        self.deletes = defaultdict(set)  # word with one letter taken out -> words it came from
+        for user in store.users():
+            for quote in store.quote_list(user):
+                self.quote_added(user, quote)
+        store.listeners.append(self)
+
+    def quote_added(self, user, quote):
+        key = (user, quote)
+        self.counts[key] += 1
+        if self.counts[key] > 1:  # same quote stored again, already indexed
+            return
+        for word in tokenise(user, quote):
+            postings = self.postings[word]
+            if not postings:
+                self.add_word(word)
+            postings.add(key)
+
+    def quote_removed(self, user, quote):
+        key = (user, quote)
+        if key not in self.counts:
+            return
+        self.counts[key] -= 1
+        if self.counts[key] > 0:
+            return
+        del self.counts[key]
+        for word in tokenise(user, quote):
+            postings = self.postings[word]
+            postings.discard(key)
+            if not postings:
+                del self.postings[word]
+                self.remove_word(word)
+
+    def add_word(self, word):
+        bisect.insort(self.words, word)
+        for variant in deletions(word):
+            self.deletes[variant].add(word)
+
+    def remove_word(self, word):
+        i = bisect.bisect_left(self.words, word)
+        if i < len(self.words) and self.words[i] == word:
+            del self.words[i]
+        for variant in deletions(word):
+            self.deletes[variant].discard(word)
+            if not self.deletes[variant]:
+                del self.deletes[variant]
+
+    # words starting with prefix, at most max_expand of them
+    def with_prefix(self, prefix):
+        i = bisect.bisect_left(self.words, prefix)
+        words = []
+        while i < len(self.words) and self.words[i].startswith(prefix) and len(words) < self.max_expand:
+            words.append(self.words[i])
+            i += 1
+        return words
+
+    # words one letter added, taken out, changed or swapped away from term
+    def similar(self, term):
+        if len(term) < 4:  # short words have too many neighbours to be useful
+            return []
+        candidates = set(self.deletes.get(term, ()))  # one letter added
+        for variant in deletions(term):
+            if variant in self.postings:  # one letter taken out
+                candidates.add(variant)
+            candidates.update(self.deletes.get(variant, ()))  # changed or swapped
+        candidates.discard(term)
+        return [word for word in candidates if within_one_edit(term, word)][:self.max_expand]
+
+    # Returns (user, quote) of quotes matching the most terms, best first. Exact words
+    # count for more then prefixes which count for more then typos
+    def search(self, text, limit=10):
+        terms = WORD.findall(text.lower())
+        scores = defaultdict(int)
+        matched = defaultdict(int)
+        for term in terms:
+            best = {}
+            for weight, words in ((3, [term]), (2, self.with_prefix(term) if len(term) > 1 else []),
+                                  (1, self.similar(term))):
+                for word in words:
+                    for key in self.postings.get(word, ()):
+                        if best.get(key, 0) < weight:
+                            best[key] = weight
+            for key, weight in best.items():
+                scores[key] += weight
+                matched[key] += 1
+        ranked = sorted(scores, key=lambda key: (-matched[key], -scores[key], key))
+        return ranked[:limit], len(ranked)
+
+
+def tokenise(user, quote):
+    return set(WORD.findall(quote.lower())) | set(WORD.findall(user.lower()))
+
+
+def deletions(word):
+    return {word[:i] + word[i + 1:] for i in range(len(word))}
+
+
+# True if a can be turned into b by adding, removing, changing or swapping one letter
+def within_one_edit(a, b):
+    if abs(len(a) - len(b)) > 1:
+        return False
+    if len(a) > len(b):
+        a, b = b, a
+    i = 0
+    while i < len(a) and a[i] == b[i]:
+        i += 1
+    if len(a) == len(b):
+        if a[i + 1:] == b[i + 1:]:  # one letter changed
+            return True
+        return a[i + 2:] == b[i + 2:] and a[i] == b[i + 1] and a[i + 1] == b[i]  # two letters swapped
+    return a[i:] == b[i + 1:]
@@ -0,0 +1,340 @@
+import json
+import os
+import pickle
+import random
+from threading import Thread
+
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+# marks a snapshot written by QuoteStore, old quote files are a plain pickled dict
+SNAPSHOT_TAG = "jerry-quotes"
+SNAPSHOT_VERSION = 1
+
+
+class QuoteStore:
+    """
+    Holds every quote in memory keyed by the lower case name of the user.
+    Each add or delete is appended to a journal file, and once the journal
+    gets long enough it is folded into a snapshot on a background thread.
+    Changes are made holding a lock file, and with shared=True quotes other
+    processes add are read from the end of the journal before quotes are used
+    """
+
+    def __init__(self, path, compact_after=500, shared=False):
+        self.path = path  # snapshot file, uses same name as the old quotes pickle
+        self.compact_after = compact_after
+        self.shared = shared
+        self.lock = FileLock(path + ".lock")  # held while writing the journal
+        self.snapshot_lock = FileLock(path + ".snapshot.lock")  # held while writing the snapshot
+        self.quotes = {}
+        self.generation = 0  # journal currently being appended to
+        self.journal_entries = 0
+        self.offset = 0  # bytes of the current journal already applied
+        self.version = 0  # goes up on every change, used to know when views of the quotes are stale
+        self._journal = None
+        self._compactor = None
+        self.listeners = []  # told about each quote added or removed, such as the search index
+        self.quiet = False  # set while every quote is read again, listeners are told about them after
+        self.load()
+
+    def journal_path(self, generation):
+        return "{}.journal.{}".format(self.path, generation)
+
+    # finds generations of all journal files next to the snapshot
+    def journal_generations(self):
+        directory = os.path.dirname(self.path) or "."
+        prefix = os.path.basename(self.path) + ".journal."
+        generations = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                generations.append(int(name[len(prefix):]))
+        return sorted(generations)
+
+    # Loads snapshot then replays all journals written after it.
+    # Old style quote files are migrated to a snapshot the first time they are loaded
+    def load(self):
+        with self.lock:
+            snapshot_generation = self.read_all(truncate=True)
+            self.open_journal()
+            if self.generation > snapshot_generation or self.journal_entries >= self.compact_after:
+                self.compact()
+
+    # Reads snapshot and every journal after it into memory, returns generation of the snapshot.
+    # Starts again if another process folds a journal into a new snapshot while it is read.
+    # Listeners are not told about the quotes read
+    def read_all(self, truncate=False):
+        self.quiet = True
+        try:
+            return self._read_all(truncate)
+        finally:
+            self.quiet = False
+
+    def _read_all(self, truncate):
+        while True:
+            self.quotes = {}
+            snapshot_generation = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as snapshot:
+                    data = pickle.load(snapshot)
+                if isinstance(data, dict):  # old quotes pickle
+                    self.quotes = {user.lower(): list(quotes) for user, quotes in data.items() if quotes}
+                    write_snapshot(self.path, 0, self.quotes)
+                else:
+                    tag, version, snapshot_generation, self.quotes = data
+                    if tag != SNAPSHOT_TAG or version > SNAPSHOT_VERSION:
+                        raise ValueError("{} is not a quote snapshot this version can read".format(self.path))
+
+            self.generation = snapshot_generation
+            self.journal_entries = 0
+            self.offset = 0
+            generations = self.journal_generations()
+            if snapshot_generation > 0 and snapshot_generation not in generations:
+                continue  # journals after the snapshot were folded into a newer one while it was read
+            try:
+                for generation in generations:
+                    if generation < snapshot_generation:  # already part of the snapshot
+                        continue
+                    self.journal_entries, self.offset = self.replay(self.journal_path(generation), 0, truncate)
+                    self.generation = generation
+            except FileNotFoundError:
+                continue
+            return snapshot_generation
+
+    # Applies every complete entry in journal after start, returns number applied and where the
+    # last one ends. A half written last line is cut off if truncate is set, only safe holding the lock
+    def replay(self, path, start=0, truncate=False):
+        entries = 0
+        with open(path, 'rb+' if truncate else 'rb') as journal:
+            journal.seek(start)
+            data = journal.read()
+            end = data.rfind(b"\n") + 1
+            if truncate and end != len(data):  # crashed in the middle of writing an entry
+                journal.truncate(start + end)
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            self.apply(entry)
+            entries += 1
+        return entries, start + end
+
+    def open_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self.journal_path(self.generation), 'ab')
+
+    # Applies entries other processes added since the journal was last read, moving on to newer
+    # journals as they are started. Reloads everything if the journal was folded into a snapshot
+    def sync(self):
+        if not self.shared or self._journal is None:
+            return
+        while True:
+            path = self.journal_path(self.generation)
+            # checked before reading, nothing more is written to a journal once there is a newer one
+            finished = os.path.exists(self.journal_path(self.generation + 1))
+            try:
+                if os.path.getsize(path) > self.offset:
+                    entries, self.offset = self.replay(path, self.offset)
+                    self.journal_entries += entries
+            except FileNotFoundError:
+                self.reload()
+                return
+            if not finished:
+                return
+            self.generation += 1
+            self.journal_entries = 0
+            self.offset = 0
+            self.open_journal()
+
+    # reads every quote again, telling listeners they were all removed and added back
+    def reload(self):
+        self.apply(("reset",))
+        self.read_all()
+        for user, user_quotes in self.quotes.items():
+            self.notify("quote_added", user, user_quotes)
+        self.open_journal()
+
+    # changes quotes held in memory for a journal entry
+    def apply(self, entry):
+        op = entry[0]
+        if op == "add":
+            self.quotes.setdefault(entry[1], []).append(entry[2])
+            self.notify("quote_added", entry[1], [entry[2]])
+        elif op == "remove":
+            user_quotes = self.quotes.get(entry[1])
+            if user_quotes is not None and entry[2] in user_quotes:
+                user_quotes.remove(entry[2])
+                if len(user_quotes) == 0:
+                    del self.quotes[entry[1]]
+                self.notify("quote_removed", entry[1], [entry[2]])
+        elif op == "drop":
+            self.notify("quote_removed", entry[1], self.quotes.pop(entry[1], []))
+        elif op == "reset":
+            quotes, self.quotes = self.quotes, {}
+            for user, user_quotes in quotes.items():
+                self.notify("quote_removed", user, user_quotes)
+        self.version += 1
+
+    def notify(self, event, user, quotes):
+        if self.quiet:
+            return
+        for listener in self.listeners:
+            for quote in quotes:
+                getattr(listener, event)(user, quote)
+
+    # applies change and writes it to the end of the journal, after any other process's changes
+    def record(self, *entry):
+        with self.lock:
+            self.sync()
+            self.apply(entry)
+            line = (json.dumps(entry) + "\n").encode('utf-8')
+            self._journal.write(line)
+            self._journal.flush()
+            self.offset += len(line)
+            self.journal_entries += 1
+            if self.journal_entries >= self.compact_after:
+                self.compact()
+
+    # Starts a new journal and writes a snapshot of the quotes in the background.
+    # Journals older then the snapshot are removed once it is safely on disk
+    def compact(self):
+        if self._compactor is not None and self._compactor.is_alive():
+            return
+        with self.lock:
+            self.sync()
+            self.generation += 1
+            self.journal_entries = 0
+            self.offset = 0
+            self.open_journal()
+        quotes = {user: list(user_quotes) for user, user_quotes in self.quotes.items()}
+        self._compactor = Thread(target=self._write_snapshot, args=(self.generation, quotes), daemon=True)
+        self._compactor.start()
+
+    def _write_snapshot(self, generation, quotes):
+        with self.snapshot_lock:
+            if min(self.journal_generations(), default=generation) > generation:
+                return  # another process already wrote a newer snapshot
+            write_snapshot(self.path, generation, quotes)
+            for old in self.journal_generations():
+                if old < generation:
+                    os.remove(self.journal_path(old))
+
+    # waits for any snapshot being written and closes the journal
+    def close(self):
+        if self._compactor is not None:
+            self._compactor.join()
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        self.lock.close()
+        self.snapshot_lock.close()
+
+    def __contains__(self, user):
+        self.sync()
+        return user.lower() in self.quotes
+
+    def __len__(self):
+        self.sync()
+        return sum(len(user_quotes) for user_quotes in self.quotes.values())
+
+    def users(self):
+        self.sync()
+        return list(self.quotes)
+
+    def get(self, user):
+        self.sync()
+        return tuple(self.quotes.get(user.lower(), ()))
+
+    # list of quotes for user without copying it, must not be changed. Does not read
+    # changes from other processes so it can be called for each user after users()
+    def quote_list(self, user):
+        return self.quotes.get(user.lower(), ())
+
+    # returns number of quotes for each user
+    def counts(self):
+        self.sync()
+        return [(user, len(user_quotes)) for user, user_quotes in self.quotes.items()]
+
+    # returns (user, quote) picked at random, from one user if user given
+    def random_quote(self, user=None):
+        self.sync()
+        if user is None:
+            user = random.choice(list(self.quotes))
+        user = user.lower()
+        return user, random.choice(self.quotes[user])
+
+    # adds quote for user, returns True if it is the first quote for that user
+    def add(self, user, quote):
+        first = user.lower() not in self  # reads changes from other processes first
+        self.record("add", user.lower(), quote)
+        return first
+
+    # removes quote from user, returns True if user has no quotes left
+    def remove(self, user, quote):
+        self.record("remove", user.lower(), quote)
+        return user.lower() not in self.quotes
+
+    def remove_user(self, user):
+        self.record("drop", user.lower())
+
+    def reset(self):
+        self.record("reset")
+        self.compact()
+
+
+# writes snapshot next to path and moves it into place so a crash never leaves half a file
+def write_snapshot(path, generation, quotes):
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'wb') as snapshot:
+        pickle.dump((SNAPSHOT_TAG, SNAPSHOT_VERSION, generation, quotes), snapshot)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temp_path, path)
+
+
+class FileLock:
+    """
+    Lock on a file shared by every process using it, held with a with block. Can be taken
+    again by the thread already holding it. Uses flock, or msvcrt locking on windows
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.depth = 0
+
+    def __enter__(self):
+        if self.depth == 0:
+            if self.file is None:
+                self.file = open(self.path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+            else:
+                self.file.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(self.file.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError:  # gave up after trying for 10 seconds
+                        pass
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self.depth -= 1
+        if self.depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+            else:
+                self.file.seek(0)
+                msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,150 @@
+import asyncio
+import functools
+import itertools
+import re
+import time
+
+import metrics
+from ytcache import video_key
+
+# same options create_ytdl_player uses, with searching for anything that is not a url
+YTDL_OPTIONS = {
+    'format': 'webm[abr>0]/bestaudio/best',
+    'prefer_ffmpeg': True,
+    'default_search': 'auto',
+    'quiet': True,
+}
+BEFORE_OPTIONS = "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5"
+
+# urls that point at a list of songs rather then one song
+PLAYLIST_URL = re.compile(r'^https?://\S*(?:[?&]list=|/playlist\b|/sets/)')
+
+YTDL_SECONDS = metrics.histogram("jerry_ytdl_seconds", "Time youtube-dl took to look up a song not in the cache")
+
+
+# youtube-dl takes a while to import, so it is imported when first used or warmed up in the background
+def load_youtube_dl():
+    import youtube_dl
+    return youtube_dl
+
+
+# looks url up with youtube-dl, blocks so run on a worker thread
+def extract_info(url, **kwargs):
+    return load_youtube_dl().YoutubeDL(YTDL_OPTIONS).extract_info(url, download=False, **kwargs)
+
+
+class TrackResolver:
+    """
+    Looks songs up with youtube-dl on worker threads so asking for a song never waits on it.
+    Stream urls stop working after a while, so songs found long ago are looked up again
+    before they are played. Songs found before come from the cache without asking youtube,
+    and songs saved in tracks are played from disk without needing a stream at all
+    """
+
+    def __init__(self, loop, cache, tracks=None, max_running=4):
+        self.loop = loop
+        self.cache = cache
+        self.tracks = tracks  # TrackCache of songs saved to disk, or None to always stream
+        self.slots = asyncio.Semaphore(max_running)  # most lookups running at once
+        self.refresh_after = cache.stream_ttl  # seconds a stream url is trusted for
+
+    # Returns info of the first video found for url, or search text, and the time its stream url
+    # was found. Only runs youtube-dl if the cache does not have it, and skips the search if it
+    # only needs a new stream url. A cached stream url that stops working within seconds is not used
+    async def extract(self, url, within=0):
+        info, found_at = await self.loop.run_in_executor(None, self.cache.lookup, url, within)
+        if found_at is not None:
+            return info, found_at
+        async with self.slots:
+            lookup = url if info is None else info['webpage_url']
+            start = time.perf_counter()
+            found = await self.loop.run_in_executor(None, extract_info, lookup)
+            YTDL_SECONDS.observe(time.perf_counter() - start)
+        if 'entries' in found:
+            entries = list(found['entries'])
+            if not entries:
+                raise ValueError("Nothing found for {}".format(url))
+            found = entries[0]
+        await self.loop.run_in_executor(None, self.cache.save, url, found)
+        return found, time.time()
+
+    async def _resolve(self, entry, url, within=0):
+        entry.info, entry.resolved_at = await self.extract(url, within)
+        return entry.info
+
+    # starts looking up entry in the background if it has not been already, returns future of its info
+    def resolve(self, entry):
+        if entry.resolving is None:
+            entry.resolving = asyncio.ensure_future(self._resolve(entry, entry.query))
+        return entry.resolving
+
+    # True if the stream of entry is old, or will be within seconds
+    def is_stale(self, entry, within=0):
+        return entry.resolved_at is None or time.time() + within - entry.resolved_at > self.refresh_after
+
+    # starts looking up stream of entry again if it is old, or will be within seconds, returns future of its info
+    def refresh(self, entry, within=0):
+        resolving = self.resolve(entry)
+        if resolving.done() and entry.info is not None and self.is_stale(entry, within):
+            url = entry.info.get('webpage_url') or entry.query
+            entry.resolving = asyncio.ensure_future(self._resolve(entry, url, within))
+            entry.resolving.add_done_callback(lambda future: future.cancelled() or future.exception())
+        return entry.resolving
+
+    # Returns (title, entries) of playlist at url, or None if it is not a playlist. Entries is a
+    # generator walking the playlist page by page as it is read, use next_entries to read it
+    async def open_playlist(self, url):
+        async with self.slots:
+            found = await self.loop.run_in_executor(None, functools.partial(extract_info, url, process=False))
+            for _ in range(3):  # video urls with a list in them point at the playlist
+                if found.get('_type') not in ('url', 'url_transparent'):
+                    break
+                found = await self.loop.run_in_executor(None, functools.partial(
+                    extract_info, found['url'], ie_key=found.get('ie_key'), process=False))
+        if found.get('_type') not in ('playlist', 'multi_video'):
+            return None
+        return found.get('title') or url, iter(found.get('entries') or ())
+
+    # reads up to count more songs from entries of a playlist, returns url of each song
+    async def next_entries(self, entries, count):
+        async with self.slots:
+            page = await self.loop.run_in_executor(None, lambda: list(itertools.islice(entries, count)))
+        return [entry_url(entry) for entry in page if entry]
+
+    # Waits until entry is found and makes a player for it, playing the saved file if
+    # there is one and otherwise a stream that is still good
+    async def create_player(self, voice, entry, after=None):
+        await self.resolve(entry)
+        path = None
+        if self.tracks is not None:
+            path = self.tracks.lookup(video_key(entry.info))
+        if path is not None:
+            player = voice.create_ffmpeg_player(path, after=after)
+        else:
+            if self.is_stale(entry):
+                await self.refresh(entry)
+            if self.tracks is not None:
+                self.tracks.played(video_key(entry.info), entry.info)
+            player = voice.create_ffmpeg_player(entry.info['url'], before_options=BEFORE_OPTIONS, after=after)
+        info = entry.info
+
+        # same details create_ytdl_player puts on its players
+        player.download_url = info.get('url')
+        player.url = info.get('webpage_url')
+        player.views = info.get('view_count')
+        player.is_live = bool(info.get('is_live'))
+        player.likes = info.get('like_count')
+        player.dislikes = info.get('dislike_count')
+        player.duration = info.get('duration')
+        player.uploader = info.get('uploader')
+        player.title = info.get('title')
+        player.description = info.get('description')
+        return player
+
+
+# url of a song from a playlist, youtube playlists only give the video id
+def entry_url(entry):
+    url = entry.get('url') or entry.get('webpage_url') or entry['id']
+    if "://" not in url and entry.get('ie_key', 'Youtube') == 'Youtube':
+        return "https://www.youtube.com/watch?v=" + url
+    return url
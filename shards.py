@@ -0,0 +1,111 @@
+"""
+Runs the bot as several processes, each connected to discord as one shard and looking after
+the servers discord gives it. Shards that crash are started again, waiting longer each time
+one keeps crashing. The bot's token is read from JERRY_TOKEN.
+
+    python shards.py 4              runs 4 shards
+    python shards.py 4 --fake 30    runs 4 shards against fakegateway for 30 seconds and
+                                    prints how many commands were handled a second
+"""
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+RESTART_DELAY = 1  # seconds before a crashed shard is started again, doubled each crash in a row
+MAX_RESTART_DELAY = 60
+STABLE_AFTER = 60  # seconds a shard has to run before its crashes in a row are forgotten
+
+
+class Shard:
+    def __init__(self, shard_id, shard_count, fake):
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.fake = fake
+        self.process = None
+        self.started = 0.0
+        self.crashes = 0  # in a row
+        self.restart_at = None
+
+    def start(self):
+        env = dict(os.environ, JERRY_SHARD_ID=str(self.shard_id), JERRY_SHARD_COUNT=str(self.shard_count))
+        if self.fake:
+            env['JERRY_FAKE_GATEWAY'] = str(self.fake)
+        self.process = subprocess.Popen([sys.executable, "Jerry.py"], env=env,
+                                        stdout=subprocess.PIPE if self.fake else None, universal_newlines=True)
+        self.started = time.monotonic()
+        self.restart_at = None
+
+    # checks if the shard has ended, returns True if it ended on purpose and should not be started again
+    def check(self):
+        if self.process is None:
+            return self.restart_at is None
+        code = self.process.poll()
+        if code is None:
+            return False
+        self.process = None
+        if code == 0:
+            return True
+        if time.monotonic() - self.started > STABLE_AFTER:
+            self.crashes = 0
+        delay = min(MAX_RESTART_DELAY, RESTART_DELAY * 2 ** self.crashes)
+        self.crashes += 1
+        print("Shard {} exited with {}, starting it again in {}s".format(self.shard_id, code, delay), file=sys.stderr)
+        self.restart_at = time.monotonic() + delay
+        return False
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+
+
+# starts every shard and keeps them running until they all end or the supervisor is stopped
+def supervise(shards):
+    def stop(*args):
+        for shard in shards:
+            shard.stop()
+        sys.exit(1)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for shard in shards:
+        shard.start()
+    results = []
+    running = list(shards)
+    while running:
+        time.sleep(0.5)
+        for shard in list(running):
+            process = shard.process
+            if shard.check():
+                running.remove(shard)
+                if shard.fake and process is not None:
+                    results.append(json.loads(process.stdout.read().strip().splitlines()[-1]))
+            elif shard.restart_at is not None and time.monotonic() >= shard.restart_at:
+                shard.start()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the bot as several shards")
+    parser.add_argument("shards", type=int, nargs='?', default=os.cpu_count() or 1)
+    parser.add_argument("--fake", type=float, default=0, metavar="SECONDS",
+                        help="run against a stand-in gateway for this long and print throughput")
+    args = parser.parse_args()
+    if not args.fake and not os.environ.get("JERRY_TOKEN"):
+        parser.error("set JERRY_TOKEN to the bot's token, each shard reads it from there")
+
+    results = supervise([Shard(n, args.shards, args.fake) for n in range(args.shards)])
+    if args.fake:
+        for result in sorted(results, key=lambda result: result['shard']):
+            fmt = "shard {shard}: {servers} servers, {commands} commands in {seconds:.1f}s, " \
+                  "p50 {p50:.4f}s p99 {p99:.4f}s"
+            print(fmt.format(**result))
+        total = sum(result['commands'] / result['seconds'] for result in results)
+        print("{} shards handled {:.0f} commands a second".format(args.shards, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import asyncio
+import sys
+import time
+from collections import OrderedDict
+
+# what happened to a clip asked for
+QUEUED = "queued"
+MERGED = "merged"  # same clip was already waiting or had only just started, so it plays once
+COOLDOWN = "cooldown"  # user asked for a clip too recently
+FULL = "full"
+
+
+class ClipQueue:
+    """
+    Soundboard clips waiting to play in one server, played one after another on a task
+    instead of all at once. A clip asked for while the same clip is waiting, or within
+    merge_within seconds of it starting, is merged into it. Each user can only ask for
+    a clip every cooldown seconds and at most max_queued clips wait, so a burst of
+    requests only ever holds a few entries
+    """
+
+    def __init__(self, loop, play, max_queued=5, merge_within=2.0, cooldown=3.0):
+        self.loop = loop
+        self.play = play  # coroutine function(name, volume, after) starting the clip, returns its track or None
+        self.max_queued = max_queued
+        self.merge_within = merge_within
+        self.cooldown = cooldown
+        self.pending = OrderedDict()  # (name, volume) -> None, in the order asked for
+        self.playing = None  # (name, volume) of clip playing
+        self.started = 0.0  # time clip playing started
+        self.track = None
+        self.next_request = OrderedDict()  # user id -> time they can next ask for a clip, soonest first
+        self.max_users = 1000  # users in cooldown kept, the ones closest to the end of it are let go first
+        self.task = None
+
+    # Asks for clip name at volume to be played for user. Returns QUEUED, MERGED, COOLDOWN or FULL
+    def request(self, user_id, name, volume):
+        now = time.monotonic()
+        if self.next_request.get(user_id, 0.0) > now:
+            return COOLDOWN
+        key = (name, volume)
+        if key in self.pending or (key == self.playing and now - self.started < self.merge_within):
+            result = MERGED
+        elif len(self.pending) >= self.max_queued:
+            return FULL
+        else:
+            self.pending[key] = None
+            result = QUEUED
+            if self.task is None:
+                self.task = self.loop.create_task(self.run())
+        self.wait_for_user(user_id, now)
+        return result
+
+    def wait_for_user(self, user_id, now):
+        self.next_request.pop(user_id, None)
+        self.next_request[user_id] = now + self.cooldown
+        while self.next_request:
+            user, until = next(iter(self.next_request.items()))
+            if until > now and len(self.next_request) <= self.max_users:
+                break
+            del self.next_request[user]
+
+    def __len__(self):
+        return len(self.pending)
+
+    # plays clips waiting until there are none left, waiting for each to end before the next
+    async def run(self):
+        try:
+            while self.pending:
+                (name, volume), _ = self.pending.popitem(last=False)
+                self.playing, self.started = (name, volume), time.monotonic()
+                ended = asyncio.Event()
+                try:
+                    self.track = await self.play(name, volume, lambda: self.loop.call_soon_threadsafe(ended.set))
+                except Exception as e:
+                    print("Could not play clip {}: {}".format(name, e), file=sys.stderr)
+                    continue
+                if self.track is not None:
+                    await ended.wait()
+        finally:
+            self.playing = None
+            self.track = None
+            self.task = None
+
+    # drops clips waiting and stops the one playing
+    def clear(self):
+        self.pending.clear()
+        if self.track is not None:
+            self.track.stop()
+
+    def close(self):
+        self.clear()
+        if self.task is not None:
+            self.task.cancel()
@@ -0,0 +1,177 @@
+import array
+import asyncio
+import audioop
+import hashlib
+import mmap
+import os
+import subprocess
+import threading
+import time
+
+import discord
+
+import metrics
+
+SAMPLING_RATE = 48000
+CHANNELS = 2
+FRAME_LENGTH = 20  # milliseconds of audio in each opus frame
+FRAME_SIZE = SAMPLING_RATE // 1000 * FRAME_LENGTH * CHANNELS * 2  # bytes of 16 bit pcm in a frame
+
+# start of every frame cache file, changes if the layout of the file changes
+CACHE_MAGIC = b"JRYOPUS2"
+
+OPUS_LOCK = threading.Lock()  # opus can be loaded from the event loop and encoding threads at once
+
+FFMPEG_SECONDS = metrics.histogram("jerry_ffmpeg_seconds", "Time ffmpeg took to decode or transcode audio", ("job",))
+
+
+class Clip:
+    """
+    Sound clip already encoded into opus frames ready to be sent to discord, along
+    with its pcm for mixing. Held in a buffer memory mapped from the frame cache
+    """
+
+    def __init__(self, name, buffer, pcm_start, offsets):
+        self.name = name
+        self.buffer = buffer
+        self.pcm_start = pcm_start  # pcm frame i starts at pcm_start + i * FRAME_SIZE
+        self.offsets = offsets  # opus frame i is buffer[offsets[i]:offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def duration(self):
+        return len(self) * FRAME_LENGTH / 1000
+
+    def frame(self, i):
+        return bytes(self.buffer[self.offsets[i]:self.offsets[i + 1]])
+
+    def frames(self):
+        for i in range(len(self)):
+            yield self.frame(i)
+
+    def pcm(self, i):
+        start = self.pcm_start + i * FRAME_SIZE
+        return self.buffer[start:start + FRAME_SIZE]
+
+
+class SoundLibrary:
+    """
+    Decodes and encodes clips from the sound folder once so playing them does not
+    start ffmpeg each time. Encoded clips are also written to a frame cache on disk
+    which is memory mapped back in after a restart
+    """
+
+    def __init__(self, directory, cache_directory, loop, executor=None):
+        self.directory = directory
+        self.cache_directory = cache_directory
+        self.loop = loop
+        self.executor = executor
+        self.clips = {}  # (name, volume) -> Clip
+        self.loading = {}  # (name, volume) -> future of clip being loaded
+        os.makedirs(cache_directory, exist_ok=True)
+
+    # returns clip for sound at volume, loading it on a worker thread the first time
+    async def get(self, name, volume):
+        clip = self.clips.get((name, volume))
+        if clip is not None:
+            return clip
+        future = self.loading.get((name, volume))
+        if future is None:
+            future = self.loading[(name, volume)] = self.loop.run_in_executor(self.executor, self.load, name, volume)
+        try:
+            clip = await asyncio.shield(future)
+        finally:
+            self.loading.pop((name, volume), None)
+        self.clips[(name, volume)] = clip
+        return clip
+
+    # Key of clip in the frame cache. Includes size and time changed of the
+    # sound file so clips replaced in the sound folder are encoded again
+    def cache_path(self, name, volume):
+        info = os.stat(os.path.join(self.directory, name))
+        key = "{}|{}|{}|{}".format(name, info.st_size, info.st_mtime_ns, volume)
+        return os.path.join(self.cache_directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".frames")
+
+    # loads clip from frame cache or encodes it if it is not there, blocks so run on a worker thread
+    def load(self, name, volume):
+        path = self.cache_path(name, volume)
+        if os.path.exists(path):
+            try:
+                return read_frames(name, path)
+            except ValueError:  # file left from an older layout or cut short
+                pass
+        pcm, frames = encode(decode(os.path.join(self.directory, name)), volume)
+        write_frames(path, pcm, frames)
+        return read_frames(name, path)
+
+
+# runs ffmpeg on source, a file or audio already in memory, and returns its audio as 48KHz stereo 16 bit pcm
+def decode(source):
+    start = time.perf_counter()
+    piped = isinstance(source, bytes)
+    process = subprocess.run(["ffmpeg", "-loglevel", "error", "-i", "pipe:0" if piped else source, "-f", "s16le",
+                              "-ar", str(SAMPLING_RATE), "-ac", str(CHANNELS), "pipe:1"],
+                             input=source if piped else None, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise RuntimeError("ffmpeg could not decode {}: {}".format("audio" if piped else source,
+                                                                   process.stderr.decode(errors='replace')))
+    FFMPEG_SECONDS.observe(time.perf_counter() - start, "decode")
+    return process.stdout
+
+
+# Loads the opus library the first time it is needed instead of when the bot starts.
+# The 'opus' library here is opus.dll on windows or libopus.so on linux in the current directory,
+# replace this with the location and name of the opus library if it is somewhere else.
+# On windows this DLL is automatically provided
+def load_opus():
+    with OPUS_LOCK:
+        if not discord.opus.is_loaded():
+            discord.opus.load_opus('opus')
+
+
+# Splits pcm into frames at volume and encodes each one to opus.
+# Returns the pcm at volume padded to whole frames and the opus frames
+def encode(pcm, volume):
+    if volume != 1.0:
+        pcm = audioop.mul(pcm, 2, min(volume, 2.0))
+    if len(pcm) % FRAME_SIZE:  # pad last frame with silence
+        pcm += bytes(FRAME_SIZE - len(pcm) % FRAME_SIZE)
+    load_opus()
+    encoder = discord.opus.Encoder(SAMPLING_RATE, CHANNELS)
+    frames = [encoder.encode(pcm[i:i + FRAME_SIZE], encoder.samples_per_frame) for i in range(0, len(pcm), FRAME_SIZE)]
+    return pcm, frames
+
+
+# Writes clip to path as: magic, frame count, offset of each opus frame, pcm, opus frames.
+# Written to a temp file first so a half written cache is never read
+def write_frames(path, pcm, frames):
+    header = len(CACHE_MAGIC) + 4 + 4 * (len(frames) + 1)
+    offsets = array.array('I', [header + len(pcm)])
+    for frame in frames:
+        offsets.append(offsets[-1] + len(frame))
+    temp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(temp_path, 'wb') as file:
+        file.write(CACHE_MAGIC)
+        file.write(array.array('I', [len(frames)]).tobytes())
+        file.write(offsets.tobytes())
+        file.write(pcm)
+        for frame in frames:
+            file.write(frame)
+    os.replace(temp_path, path)
+
+
+# memory maps frame cache file at path and returns it as a Clip
+def read_frames(name, path):
+    with open(path, 'rb') as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    if buffer[:len(CACHE_MAGIC)] != CACHE_MAGIC:
+        raise ValueError("{} is not a frame cache file".format(path))
+    start = len(CACHE_MAGIC)
+    count = array.array('I', buffer[start:start + 4])[0]
+    offsets = array.array('I', buffer[start + 4:start + 4 + 4 * (count + 1)])
+    pcm_start = start + 4 + 4 * (count + 1)
+    if len(offsets) != count + 1 or offsets[-1] != len(buffer) or offsets[0] - pcm_start != count * FRAME_SIZE:
+        raise ValueError("{} is cut short".format(path))
+    return Clip(name, memoryview(buffer), pcm_start, offsets)
@@ -0,0 +1,148 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from collections import Counter, OrderedDict
+
+from resolver import BEFORE_OPTIONS
+from soundlibrary import FFMPEG_SECONDS
+
+
+class TrackCache:
+    """
+    Keeps songs that are played often transcoded to opus on disk so they are played from a
+    file instead of being streamed and decoded again. Songs are only saved once they have
+    been played min_plays times, and the least recently played are removed when over budget.
+    With shared=True other processes save songs to the same directory, so it is read again
+    before removing songs and the budget covers every process's songs
+    """
+
+    def __init__(self, directory, loop, max_bytes=2 * 1024 * 1024 * 1024, min_plays=3, max_duration=15 * 60,
+                 max_running=1, shared=False, scan_every=60):
+        self.directory = directory
+        self.loop = loop
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.max_duration = max_duration  # longer songs are always streamed
+        self.slots = asyncio.Semaphore(max_running)  # transcodes running at once
+        self.entries = OrderedDict()  # file name -> size, least recently played first
+        self.size = 0
+        self.plays = Counter()  # video key -> times played, halved when it gets big so old plays count less
+        self.transcoding = {}  # video key -> task saving it
+        self.hits = 0
+        self.misses = 0
+        self.shared = shared
+        self.scan_every = scan_every  # seconds the directory is trusted for between reads when shared
+        self.scanned = 0.0
+        os.makedirs(directory, exist_ok=True)
+        for name in os.listdir(directory):
+            if name.endswith(".tmp"):
+                if os.stat(os.path.join(directory, name)).st_mtime < time.time() - 60 * 60:  # transcode never finished
+                    os.remove(os.path.join(directory, name))
+        self.scan()
+
+    # reads the songs saved in the directory, by this process or any other, oldest played first
+    def scan(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".opus"):
+                try:
+                    info = os.stat(self.path(name))
+                except OSError:  # removed by another process meanwhile
+                    continue
+                files.append((info.st_mtime, name, info.st_size))
+        self.entries = OrderedDict()
+        self.size = 0
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        self.scanned = time.monotonic()
+
+    @staticmethod
+    def file_name(key):
+        return key.replace(":", "_").replace("/", "_") + ".opus"
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # returns path of saved song for video key, None if it is not saved
+    def lookup(self, key):
+        name = self.file_name(key)
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            try:
+                os.utime(self.path(name))  # keeps order of play over restarts
+                self.hits += 1
+                return self.path(name)
+            except OSError:  # removed from outside the bot
+                self.forget(name)
+        elif os.path.exists(self.path(name)):  # saved by another shard
+            self.entries[name] = os.path.getsize(self.path(name))
+            self.size += self.entries[name]
+            self.evict()
+            self.hits += 1
+            return self.path(name)
+        self.misses += 1
+        return None
+
+    # counts song being played from info and starts saving it if it is played often enough
+    def played(self, key, info):
+        self.plays[key] += 1
+        if len(self.plays) > 10000:
+            self.plays = Counter({key: plays // 2 for key, plays in self.plays.items() if plays > 1})
+        if self.plays[key] < self.min_plays or key in self.transcoding or self.file_name(key) in self.entries:
+            return
+        if info.get('is_live') or not info.get('duration') or info['duration'] > self.max_duration:
+            return
+        task = self.transcoding[key] = asyncio.ensure_future(self.save(key, info['url']))
+        task.add_done_callback(lambda _: self.transcoding.pop(key, None))
+
+    async def save(self, key, url):
+        name = self.file_name(key)
+        temp_path = self.path("{}.{}.tmp".format(name, os.getpid()))
+        async with self.slots:
+            try:
+                await self.loop.run_in_executor(None, transcode, url, temp_path)
+            except Exception as e:
+                print("Could not save {}: {}".format(key, e), file=sys.stderr)
+                return
+        os.replace(temp_path, self.path(name))
+        self.forget(name)
+        self.entries[name] = os.path.getsize(self.path(name))
+        self.size += self.entries[name]
+        self.evict()
+
+    def forget(self, name):
+        size = self.entries.pop(name, None)
+        if size is not None:
+            self.size -= size
+
+    # removes least recently played songs until under budget, always keeping the newest
+    def evict(self):
+        if self.shared and time.monotonic() - self.scanned > self.scan_every:
+            self.scan()
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(name))
+            except OSError:  # still being played, it is removed when seen again after a restart
+                pass
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# runs ffmpeg to save stream at url to path as opus, blocks so run on a worker thread
+def transcode(url, path):
+    start = time.perf_counter()
+    process = subprocess.run(["ffmpeg", "-y", "-loglevel", "error"] + BEFORE_OPTIONS.split() +
+                             ["-i", url, "-vn", "-ac", "2", "-ar", "48000", "-c:a", "libopus", "-b:a", "96k",
+                              "-f", "ogg", path], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        if os.path.exists(path):
+            os.remove(path)
+        raise RuntimeError(process.stderr.decode(errors='replace').strip())
+    FFMPEG_SECONDS.observe(time.perf_counter() - start, "transcode")
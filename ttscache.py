@@ -0,0 +1,136 @@
+import hashlib
+import io
+import json
+import os
+import time
+from collections import OrderedDict
+
+
+class TTSCache:
+    """
+    Keeps audio made by gTTS on disk so the same text is only synthesised once.
+    Each clip gets its own file named after a hash of its text, language and speed,
+    and the least recently used clips are removed when over the size budget. With
+    shared=True other processes add clips to the same directory, so it is read again
+    before removing clips and the budget covers every process's clips
+    """
+
+    def __init__(self, directory, max_bytes=50 * 1024 * 1024, shared=False, scan_every=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # file name -> size, least recently used first
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.shared = shared
+        self.scan_every = scan_every  # seconds the directory is trusted for between reads when shared
+        self.scanned = 0.0
+        os.makedirs(directory, exist_ok=True)
+        self.scan()
+
+    # reads the clips in the directory, made by this process or any other, oldest used first
+    def scan(self):
+        files = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".mp3"):
+                try:
+                    info = os.stat(self.path(name))
+                except OSError:  # removed by another process meanwhile
+                    continue
+                files.append((info.st_mtime, name, info.st_size))
+        self.entries = OrderedDict()
+        self.size = 0
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        self.scanned = time.monotonic()
+
+    @staticmethod
+    def key(text, lang, slow):
+        return hashlib.sha1(json.dumps([text, lang, slow]).encode('utf-8')).hexdigest()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    # returns path of cached clip or None if it has not been made yet
+    def lookup(self, text, lang, slow):
+        name = self.key(text, lang, slow) + ".mp3"
+        if name in self.entries:
+            self.entries.move_to_end(name)
+            try:
+                os.utime(self.path(name))  # keeps order of use over restarts
+                self.hits += 1
+                return self.path(name)
+            except OSError:  # removed from outside the bot
+                self.forget(name)
+        elif os.path.exists(self.path(name)):  # made by another shard
+            self.add(name, os.path.getsize(self.path(name)))
+            self.hits += 1
+            return self.path(name)
+        self.misses += 1
+        return None
+
+    # returns path of clip for text, synthesising it if it is not cached
+    def get(self, text, lang, slow=False):
+        path = self.lookup(text, lang, slow)
+        if path is None:
+            name, size = self.render(text, lang, slow)
+            self.add(name, size)
+            path = self.path(name)
+        return path
+
+    # Writes clip to disk and returns its file name and size. Does not touch
+    # the list of entries so it is safe to run on a worker thread
+    def render(self, text, lang, slow):
+        return self.write(text, lang, slow, synthesise(text, lang, slow))
+
+    # Writes audio already made for text to disk and returns its file name and size,
+    # safe to run on a worker thread like render
+    def write(self, text, lang, slow, data):
+        name = self.key(text, lang, slow) + ".mp3"
+        temp_path = self.path("{}.{}.tmp".format(name, os.getpid()))
+        with open(temp_path, 'wb') as clip:
+            clip.write(data)
+        os.replace(temp_path, self.path(name))
+        return name, len(data)
+
+    def add(self, name, size):
+        self.forget(name)
+        self.entries[name] = size
+        self.size += size
+        self.evict()
+
+    def forget(self, name):
+        size = self.entries.pop(name, None)
+        if size is not None:
+            self.size -= size
+
+    # removes least recently used clips until under budget, always keeping the newest
+    def evict(self):
+        if self.shared and time.monotonic() - self.scanned > self.scan_every:
+            self.scan()
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self.path(name))
+            except OSError:  # still open by a player, it is removed when seen again
+                pass
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+# returns mp3 of text made by gTTS in memory, blocks so run on a worker thread
+def synthesise(text, lang, slow):
+    data = io.BytesIO()
+    load_gtts().gTTS(text=text, lang=lang, slow=slow).write_to_fp(data)
+    return data.getvalue()
+
+
+# gTTS pulls in requests and more, so it is imported when first used or warmed up in the background
+def load_gtts():
+    import gtts
+    return gtts
+
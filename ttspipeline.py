@@ -0,0 +1,212 @@
+import asyncio
+import re
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+from soundlibrary import FRAME_LENGTH, decode
+from ttscache import synthesise
+
+TTS_SECONDS = metrics.histogram("jerry_tts_seconds", "Time gTTS took to synthesise a clip not in the cache")
+TTS_FIRST_AUDIO = metrics.histogram("jerry_tts_first_audio_seconds",
+                                    "Time from tts being asked for until the first of it was ready to play")
+
+# ends of sentences, split after so each sentence can be synthesised on its own
+SENTENCE_END = re.compile(r'(?<=[.!?;:])\s+|(?<=[\u3002\uff01\uff1f])')
+
+
+# Splits text into pieces at the ends of sentences, cutting sentences longer then limit at a space.
+# The first sentence is kept on its own so it is ready soonest, the rest are joined up to limit
+def split_text(text, limit=200):
+    pieces = []
+    for sentence in SENTENCE_END.split(text.strip()):
+        while len(sentence) > limit:
+            cut = sentence.rfind(" ", 0, limit)
+            if cut <= 0:  # no spaces, such as japanese
+                cut = limit
+            pieces.append(sentence[:cut])
+            sentence = sentence[cut:].lstrip()
+        if sentence:
+            pieces.append(sentence)
+    chunks = pieces[:1]
+    for piece in pieces[1:]:
+        if len(chunks) > 1 and len(chunks[-1]) + 1 + len(piece) <= limit:
+            chunks[-1] += " " + piece
+        else:
+            chunks.append(piece)
+    return chunks
+
+
+class TTSPipeline:
+    """
+    Synthesises tts on a pool of worker threads so gTTS never runs on the event loop.
+    Requests in one server are played in order while different servers synthesise
+    at the same time, with a cap on how many syntheses can run at once. Long text is
+    streamed, synthesised a sentence at a time with the first playing while the rest are made
+    """
+
+    def __init__(self, cache, loop, workers=4, max_in_flight=4, ahead=2.0, stream_ahead=2):
+        self.cache = cache
+        self.loop = loop
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.server_locks = {}  # server id -> lock keeping that server's tts in order
+        self.rendering = {}  # cache key -> future of synthesis already running for it
+        self.synthesising = {}  # cache key -> future of synthesis in memory already running for it, when streaming
+        self.waiting = 0  # requests waiting for their server or a free slot
+        self.in_flight = 0
+        self.ahead_frames = int(ahead * 1000 / FRAME_LENGTH)  # audio decoded before it is needed when streaming
+        self.stream_ahead = stream_ahead  # chunks of one streamed message being made at once
+
+    # number of tts requests that have not started synthesising yet
+    def queue_depth(self):
+        return self.waiting
+
+    # Lock held while a server's tts is made and started playing.
+    # Removed again when nothing is using it so servers that stop talking are not kept
+    def server_lock(self, server_id):
+        lock = self.server_locks.get(server_id)
+        if lock is None:
+            lock = self.server_locks[server_id] = ServerLock(self, server_id)
+        return lock
+
+    # returns path of clip for text, synthesising it on a worker thread if needed
+    async def render(self, text, lang, slow=False):
+        path = self.cache.lookup(text, lang, slow)
+        if path is not None:
+            return path
+
+        key = self.cache.key(text, lang, slow)
+        future = self.rendering.get(key)
+        if future is None:  # nobody else is making this clip
+            future = self.rendering[key] = asyncio.ensure_future(self._render(text, lang, slow))
+            future.add_done_callback(lambda _: self.rendering.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _render(self, text, lang, slow):
+        name, size = await self.run_synthesis(self.cache.render, text, lang, slow)
+        self.cache.add(name, size)
+        return self.cache.path(name)
+
+    # Returns path of clip for text if it is cached or being made for the cache, otherwise
+    # synthesises it in memory and returns its mp3, saving it to the cache in the background
+    async def render_audio(self, text, lang, slow=False):
+        path = self.cache.lookup(text, lang, slow)
+        if path is not None:
+            return path
+        key = self.cache.key(text, lang, slow)
+        future = self.rendering.get(key)
+        if future is not None:  # already being written to the cache
+            return await asyncio.shield(future)
+        future = self.synthesising.get(key)
+        if future is None:
+            future = self.synthesising[key] = asyncio.ensure_future(self._synthesise(text, lang, slow))
+            future.add_done_callback(lambda _: self.synthesising.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _synthesise(self, text, lang, slow):
+        data = await self.run_synthesis(synthesise, text, lang, slow)
+        saving = self.loop.run_in_executor(None, self.cache.write, text, lang, slow, data)
+        saving.add_done_callback(self.saved)
+        return data
+
+    def saved(self, future):
+        try:
+            self.cache.add(*future.result())
+        except Exception as e:
+            print("Could not save tts to the cache: {}".format(e), file=sys.stderr)
+
+    # runs function on a worker thread once a synthesis slot is free
+    async def run_synthesis(self, function, *args):
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        start = time.perf_counter()
+        try:
+            result = await self.loop.run_in_executor(self.executor, function, *args)
+            TTS_SECONDS.observe(time.perf_counter() - start)
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        return result
+
+    # Feeds the audio of each of chunks to track in order as it is ready, so the first plays while
+    # the rest are made. Chunks not in the cache are synthesised and decoded in memory without
+    # waiting for a file, and saved to the cache after. Only stream_ahead of them are made at once
+    # so one long message does not take every synthesis slot. Audio is only decoded a little
+    # before it is needed. Ends track when done
+    async def stream(self, chunks, lang, slow, track):
+        start = time.perf_counter()
+        waiting = iter(chunks)
+        renders = deque()
+
+        def render_next():
+            chunk = next(waiting, None)
+            if chunk is not None:
+                renders.append(asyncio.ensure_future(self.render_audio(chunk, lang, slow)))
+
+        for _ in range(self.stream_ahead):
+            render_next()
+        first = True
+        try:
+            while renders:
+                render = renders.popleft()
+                try:
+                    audio = await render  # path of a cached clip or mp3 in memory
+                except Exception as e:
+                    print("Could not synthesise tts: {}".format(e), file=sys.stderr)
+                    continue
+                finally:
+                    render_next()
+                while track.buffered() > self.ahead_frames and not track.done:
+                    await asyncio.sleep(FRAME_LENGTH / 1000 * self.ahead_frames / 4)
+                if track.done:  # stopped while playing
+                    break
+                track.feed(await self.loop.run_in_executor(None, decode, audio))  # tts workers may all be busy
+                if first:
+                    TTS_FIRST_AUDIO.observe(time.perf_counter() - start)
+                    first = False
+        finally:
+            for render in renders:
+                render.cancel()
+            track.end()
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+class ServerLock:
+    """
+    asyncio lock for one server that counts how many requests are waiting on it
+    """
+
+    def __init__(self, pipeline, server_id):
+        self.pipeline = pipeline
+        self.server_id = server_id
+        self.lock = asyncio.Lock()
+        self.users = 0
+
+    async def __aenter__(self):
+        self.users += 1
+        self.pipeline.waiting += 1
+        try:
+            await self.lock.acquire()
+        except BaseException:
+            self.leave()
+            raise
+        finally:
+            self.pipeline.waiting -= 1
+
+    async def __aexit__(self, *exc):
+        self.lock.release()
+        self.leave()
+
+    def leave(self):
+        self.users -= 1
+        if self.users == 0:
+            self.pipeline.server_locks.pop(self.server_id, None)
@@ -0,0 +1,104 @@
+import datetime
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+import metrics
+
+LOOP_LAG = metrics.histogram("jerry_loop_lag_seconds", "How late the event loop ran the watchdog's heartbeat",
+                             buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+STALLS = metrics.counter("jerry_loop_stalls_total", "Times the event loop was blocked for longer then the threshold")
+
+
+class Stall:
+    def __init__(self, duration, stack, samples, caught):
+        self.duration = duration  # seconds the loop was blocked
+        self.stack = stack  # lines of the stack seen most while blocked, None if it ended before one was taken
+        self.samples = samples  # stacks taken while blocked
+        self.caught = caught  # times stack was the one seen
+        self.when = datetime.datetime.now()
+
+
+class StallWatchdog(threading.Thread):
+    """
+    Measures how late the event loop runs a heartbeat scheduled every interval seconds.
+    A thread watches for the heartbeat going missing and takes the stack of the loop's thread
+    while it is blocked, so whatever is blocking it is caught in the act. The worst stalls
+    over threshold and the most recent ones are kept
+    """
+
+    def __init__(self, loop, threshold=0.1, interval=0.05, keep=10, depth=12):
+        threading.Thread.__init__(self, daemon=True)
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.sample_every = threshold / 4
+        self.depth = depth  # stack frames kept, innermost last
+        self.keep = keep
+        self.worst = []  # longest stalls, longest first
+        self.recent = deque(maxlen=keep)
+        self.lock = threading.Lock()
+        self.loop_thread = None
+        self.last_beat = time.monotonic()
+        self.expected = None  # time the next heartbeat should run
+        self.samples = []  # stacks taken since the last heartbeat
+        self.handle = None
+        self._end = threading.Event()
+
+    def start(self):
+        self.handle = self.loop.call_soon_threadsafe(self.beat)
+        threading.Thread.start(self)
+
+    def stop(self):
+        self._end.set()
+        if self.handle is not None:
+            self.handle.cancel()
+
+    # runs on the event loop, anything it runs late by is time the loop was blocked
+    def beat(self):
+        now = time.monotonic()
+        with self.lock:
+            self.loop_thread = threading.get_ident()
+            self.last_beat = now
+            samples, self.samples = self.samples, []
+        if self.expected is not None:
+            lag = max(0.0, now - self.expected)
+            LOOP_LAG.observe(lag)
+            if lag > self.threshold:
+                self.record(lag, samples)
+        if not self._end.is_set():
+            self.expected = now + self.interval
+            self.handle = self.loop.call_later(self.interval, self.beat)
+
+    def record(self, duration, samples):
+        STALLS.inc()
+        stack, caught = None, 0
+        if samples:
+            stack, caught = Counter(samples).most_common(1)[0]
+        stall = Stall(duration, stack, len(samples), caught)
+        self.recent.append(stall)
+        self.worst.append(stall)
+        self.worst.sort(key=lambda stall: stall.duration, reverse=True)
+        del self.worst[self.keep:]
+
+    def clear(self):
+        self.worst = []
+        self.recent.clear()
+
+    # takes the stack of the loop's thread each time the heartbeat is overdue
+    def run(self):
+        while not self._end.wait(self.sample_every):
+            with self.lock:
+                beat = self.last_beat
+                if self.loop_thread is None or time.monotonic() - beat < self.interval + self.threshold:
+                    continue
+                frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            stack = tuple(line.rstrip() for line in traceback.format_stack(frame)[-self.depth:])
+            del frame
+            with self.lock:
+                if self.last_beat == beat:  # loop is still blocked in the same stall
+                    self.samples.append(stack)
@@ -0,0 +1,102 @@
+import array
+import os
+import random
+
+
+class WordList:
+    """
+    Lines of a text file, loaded once and reloaded when the file changes.
+    Lines are kept as one block of bytes with the offset of each line. Files bigger
+    then max_bytes only have their offsets kept and picked lines are read from disk
+    """
+
+    def __init__(self, path, max_bytes=4 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.stamp = None  # (time changed, size) of file when loaded
+        self.data = None  # contents of file, None if read from disk
+        self.offsets = array.array('Q')  # line i is data[offsets[2i]:offsets[2i + 1]]
+
+    def __len__(self):
+        self.refresh()
+        return len(self.offsets) // 2
+
+    # reloads list if file has changed since it was loaded
+    def refresh(self):
+        info = os.stat(self.path)
+        stamp = (info.st_mtime_ns, info.st_size)
+        if stamp == self.stamp:
+            return
+        if info.st_size > self.max_bytes:
+            self.data = None
+            with open(self.path, 'rb') as file:
+                self.offsets = index_lines(file)
+        else:
+            with open(self.path, 'rb') as file:
+                self.data = file.read()
+            self.offsets = index_lines([self.data])
+        self.stamp = stamp
+
+    # returns k different lines picked at random
+    def sample(self, k):
+        self.refresh()
+        picked = random.sample(range(len(self.offsets) // 2), k)
+        if self.data is not None:
+            return [self.line(self.data, i) for i in picked]
+        lines = []
+        with open(self.path, 'rb') as file:
+            for i in picked:
+                file.seek(self.offsets[2 * i])
+                lines.append(file.read(self.offsets[2 * i + 1] - self.offsets[2 * i]).decode('utf-8').rstrip("\r"))
+        return lines
+
+    def line(self, data, i):
+        return data[self.offsets[2 * i]:self.offsets[2 * i + 1]].decode('utf-8').rstrip("\r")
+
+
+class WordLists:
+    """
+    Word lists registered by name, each loaded the first time it is used
+    """
+
+    def __init__(self):
+        self.lists = {}
+
+    def register(self, name, path):
+        self.lists[name] = WordList(path)
+
+    def __contains__(self, name):
+        return name in self.lists
+
+    def sample(self, name, k):
+        return self.lists[name].sample(k)
+
+
+# Returns start and end offset of every line that is not blank in chunks of a file.
+# Reads file a chunk at a time so big files are never held in memory whole
+def index_lines(chunks, chunk_size=1024 * 1024):
+    if hasattr(chunks, 'read'):
+        file = chunks
+        chunks = iter(lambda: file.read(chunk_size), b"")
+    offsets = array.array('Q')
+    position = 0  # offset of start of chunk in file
+    start = 0  # offset of start of current line
+    blank = True  # current line only has whitespace so far
+    for chunk in chunks:
+        end = chunk.find(b"\n")
+        last = 0
+        while end != -1:
+            if not blank or chunk[last:end].strip():
+                offsets.append(start)
+                offsets.append(position + end)
+            start = position + end + 1
+            blank = True
+            last = end + 1
+            end = chunk.find(b"\n", last)
+        if chunk[last:].strip():
+            blank = False
+        position += len(chunk)
+    if not blank:  # last line has no newline
+        offsets.append(start)
+        offsets.append(position)
+    return offsets
@@ -0,0 +1,117 @@
+import json
+import re
+import sqlite3
+import threading
+import time
+
+# youtube urls all point at a video id, so different ways of writing one url are the same song
+YOUTUBE_URL = re.compile(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|embed/|shorts/|v/)|youtu\.be/)([\w-]{11})')
+
+# details of a video kept, everything else youtube-dl finds is thrown away
+KEPT = ('id', 'extractor', 'title', 'duration', 'webpage_url', 'uploader', 'view_count', 'like_count',
+        'dislike_count', 'is_live', 'description')
+FORMAT_KEPT = ('format_id', 'ext', 'acodec', 'abr', 'asr', 'filesize')
+
+
+class YTCache:
+    """
+    Keeps what youtube-dl found for each search and url in a sqlite database so songs asked
+    for again do not have to be searched for. Details of videos are kept for a long time,
+    stream urls run out so they are only kept for a short time
+    """
+
+    def __init__(self, path, info_ttl=30 * 24 * 60 * 60, stream_ttl=20 * 60):
+        self.info_ttl = info_ttl
+        self.stream_ttl = stream_ttl
+        self.lock = threading.Lock()  # used from youtube-dl worker threads
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)  # waits for other shards writing
+        self.db.execute("PRAGMA journal_mode=WAL")  # shards can read while one writes
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS queries "
+                            "(query TEXT PRIMARY KEY, video TEXT NOT NULL, saved REAL NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS videos (video TEXT PRIMARY KEY, info TEXT NOT NULL, "
+                            "saved REAL NOT NULL, stream_url TEXT, stream_saved REAL)")
+        self.hits = 0  # found with a stream url still good
+        self.partial_hits = 0  # found but stream url had to be looked up again
+        self.misses = 0
+
+    # Returns (info, time stream url was found) for query. Info has no 'url' if the stream
+    # url is too old, or will be within seconds, and is None if the query is not cached
+    def lookup(self, query, within=0):
+        now = time.time()
+        with self.lock:
+            row = self.db.execute("SELECT videos.info, videos.saved, videos.stream_url, videos.stream_saved "
+                                  "FROM queries JOIN videos ON queries.video = videos.video "
+                                  "WHERE queries.query = ? AND queries.saved > ?",
+                                  (normalise(query), now - self.info_ttl)).fetchone()
+        if row is None or row[1] < now - self.info_ttl:
+            self.misses += 1
+            return None, None
+        info = json.loads(row[0])
+        if row[2] is not None and row[3] > now + within - self.stream_ttl:
+            self.hits += 1
+            info['url'] = row[2]
+            return info, row[3]
+        self.partial_hits += 1
+        return info, None
+
+    # saves info youtube-dl found for query, under the query and the video's own url
+    def save(self, query, info):
+        now = time.time()
+        video = video_key(info)
+        kept = {key: info.get(key) for key in KEPT}
+        kept['formats'] = [{key: f.get(key) for key in FORMAT_KEPT} for f in info.get('formats') or ()]
+        stream_url = None if info.get('is_live') else info.get('url')  # live stream urls change
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO videos VALUES (?, ?, ?, ?, ?)",
+                            (video, json.dumps(kept), now, stream_url, now if stream_url else None))
+            for key in {normalise(query), video}:
+                self.db.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)", (key, video, now))
+
+    # removes query and the video it found, or everything if no query given. Returns number removed
+    def purge(self, query=None):
+        with self.lock, self.db:
+            if query is None:
+                removed = self.db.execute("DELETE FROM videos").rowcount
+                self.db.execute("DELETE FROM queries")
+                return removed
+            row = self.db.execute("SELECT video FROM queries WHERE query = ?", (normalise(query),)).fetchone()
+            if row is None:
+                return 0
+            self.db.execute("DELETE FROM queries WHERE video = ?", row)
+            return self.db.execute("DELETE FROM videos WHERE video = ?", row).rowcount
+
+    # removes everything older then the time details are kept for
+    def prune(self):
+        cutoff = time.time() - self.info_ttl
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM queries WHERE saved < ?", (cutoff,))
+            self.db.execute("DELETE FROM videos WHERE saved < ?", (cutoff,))
+
+    def size(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM videos").fetchone()[0]
+
+    def hit_rate(self):
+        total = self.hits + self.partial_hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+# Key of the video info is for. Youtube urls become youtube:<id> the same as the
+# video key so a url and the search that found it share one entry
+def video_key(info):
+    return "{}:{}".format((info.get('extractor') or 'generic').lower(), info['id'])
+
+
+def normalise(query):
+    query = " ".join(query.split())
+    match = YOUTUBE_URL.search(query)
+    if match is not None and " " not in query:
+        return "youtube:" + match.group(1)
+    if "://" in query:  # other urls can have capitals that matter
+        return query
+    return query.lower()